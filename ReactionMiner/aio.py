@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+asyncio API of the Reaction Miner pipeline.
+
+The three stages are awaitable: SymbolScraper runs as an asyncio subprocess, and the blocking
+work (hashing and xml parsing, noise cleaning, segmentation, extraction) runs in executors owned by
+the pipeline. Noise cleaning, segmentation and extraction get one thread each, so a model only ever
+runs one call at a time, while many documents can be in flight without stalling the event loop.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .pdf2text.generalParser import parseFileAsync
+
+
+class AsyncReactionMiner:
+    """
+    Awaitable PDF-to-text, segmentation and extraction stages.
+
+    Args:
+        segmentor (TopicSegmentor, optional): Segmentor used by segment(). Required for segment() and run().
+        extractor (ReactionExtractor, optional): Extractor used by extract(). Required for extract() and run().
+        parse_workers (int, optional): Threads hashing and parsing documents concurrently. Defaults to 2.
+
+    Example:
+        async with AsyncReactionMiner(TopicSegmentor(), ReactionExtractor('8b')) as miner:
+            results = await asyncio.gather(*(miner.run(pdf_path) for pdf_path in pdf_paths))
+    """
+    def __init__(self, segmentor=None, extractor=None, parse_workers=2):
+        self.segmentor = segmentor
+        self.extractor = extractor
+        self.parse_executor = ThreadPoolExecutor(parse_workers, thread_name_prefix="reactionminer-parse")
+        self.clean_executor = ThreadPoolExecutor(1, thread_name_prefix="reactionminer-clean")
+        self.segment_executor = ThreadPoolExecutor(1, thread_name_prefix="reactionminer-segment")
+        self.extract_executor = ThreadPoolExecutor(1, thread_name_prefix="reactionminer-extract")
+
+    async def parse_file(self, pdf_path, persist=True):
+        """
+        Converts a PDF file into text, see pdf2text.generalParser.parseFile.
+
+        Returns:
+            dict: The clean json object with 'fullText' and 'contents', or -1 if parsing failed.
+        """
+        return await parseFileAsync(pdf_path, persist=persist, executor=self.parse_executor,
+                                    cleanExecutor=self.clean_executor)
+
+    async def segment(self, paragraphs, si=False):
+        """
+        Segments paragraphs with TopicSegmentor.segment, or TopicSegmentor.segment_si if si is True.
+        """
+        segment = self.segmentor.segment_si if si else self.segmentor.segment
+        return await self._run(self.segment_executor, segment, paragraphs)
+
+    async def extract(self, texts, **kwargs):
+        """
+        Extracts reactions with ReactionExtractor.extract, keyword arguments are passed through.
+        """
+        return await self._run(self.extract_executor, self.extractor.extract, texts, **kwargs)
+
+    async def run(self, pdf_path, si=None, persist=True):
+        """
+        Runs the three stages on a PDF file.
+
+        Args:
+            pdf_path (str): Path to the PDF file.
+            si (bool, optional): Whether the PDF is supporting information. Defaults to '_SI' in pdf_path.
+            persist (bool, optional): Whether the PDF-to-text stage writes its json files. Defaults to True.
+
+        Returns:
+            list: The extracted reactions, or -1 if the PDF could not be parsed.
+        """
+        result = await self.parse_file(pdf_path, persist=persist)
+        if result == -1:
+            return -1
+        si = "_SI" in pdf_path if si is None else si
+        seg_texts = await self.segment(result['contents'], si=si)
+        return await self.extract(seg_texts)
+
+    def close(self):
+        for executor in (self.parse_executor, self.clean_executor, self.segment_executor, self.extract_executor):
+            executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def _run(self, executor, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pool of CPU worker processes encoding sentences with a SentenceTransformer model.
+
+Each worker loads the model once, pins its torch thread pool (and, where the platform allows it, its
+CPU affinity) to its own share of the cores, and stays alive across documents, so a CPU node encodes
+with all of its cores instead of the few a single process keeps busy.
+"""
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+_model = None
+
+
+def available_cores():
+    """
+    Returns the cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class EmbeddingPool:
+    """
+    Shards sentence batches across worker processes that keep the model loaded.
+
+    Args:
+        model_name (str): SentenceTransformer model.
+        workers (int): Number of worker processes.
+        threads (int, optional): Torch threads per worker. Defaults to the cores divided among the workers.
+        quantize (bool, optional): Run the model with int8 linear layers. Defaults to False.
+    """
+    def __init__(self, model_name, workers, threads=None, quantize=False):
+        cores = available_cores()
+        self.workers = workers
+        self.threads = threads or max(1, len(cores) // workers)
+        context = multiprocessing.get_context("spawn")
+        counter = context.Value("i", 0)
+        self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                            initargs=(model_name, self.threads, quantize, cores, counter))
+        self.dimension = None
+
+    def encode(self, sentences, batch_size=32):
+        """
+        Returns the embeddings of sentences, one row per sentence.
+        """
+        if not len(sentences):
+            if self.dimension is None:
+                self.dimension = self.executor.submit(_dimension).result()
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # sorted by length, so each shard is padded as little as possible
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        shard_size = max(1, min(batch_size, math.ceil(len(sentences) / self.workers)))
+        shards = [order[start: start + shard_size] for start in range(0, len(order), shard_size)]
+        futures = [self.executor.submit(_encode, [sentences[i] for i in shard], batch_size) for shard in shards]
+        embeddings = None
+        for shard, future in zip(shards, futures):
+            shard_embeddings = future.result()
+            if embeddings is None:
+                self.dimension = shard_embeddings.shape[1]
+                embeddings = np.zeros((len(sentences), shard_embeddings.shape[1]), dtype=shard_embeddings.dtype)
+            embeddings[shard] = shard_embeddings
+        return embeddings
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _init_worker(model_name, threads, quantize, cores, counter):
+    global _model
+    from . import registry
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # pin the worker to its own cores when there are enough to go around
+    own_cores = cores[index * threads: (index + 1) * threads]
+    if hasattr(os, "sched_setaffinity") and len(own_cores) == threads:
+        os.sched_setaffinity(0, own_cores)
+    registry.set_cpu_threads(threads)
+    _model = registry.sentence_transformer(model_name, device="cpu", quantize=quantize)
+
+
+def _encode(sentences, batch_size):
+    return _model.encode(sentences, batch_size=batch_size)
+
+
+def _dimension():
+    return _model.get_sentence_embedding_dimension()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sentence encoder shared by the noise filter and topic segmentation.
+
+In shared encoder mode (pdf2text.config.sharedEncoder, TopicSegmentor(shared_encoder=True)) a paper is
+embedded once, at sentence level: the noise filter pools paragraph vectors from the sentence vectors,
+and C99 reuses the same vectors, which are cached by sentence text. Only one encoder model is loaded.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import registry
+from .segmentation.segmentor import sentence_vectors_namespace, split_sentences
+
+
+class SentenceEncoder:
+    """
+    Embeds sentences, caching the vector of each sentence.
+
+    Args:
+        model_name (str): SentenceTransformer model.
+        quantize (bool, optional): Run the model on CPU with int8 linear layers. Defaults to False.
+        cache_size (int, optional): Sentence vectors kept in memory. Defaults to 100000.
+    """
+    def __init__(self, model_name, quantize=False, cache_size=100000):
+        self.vectors_namespace = sentence_vectors_namespace(model_name, quantize)
+        device = None if quantize else str(registry.torch_device())
+        self.model = registry.sentence_transformer(model_name, device=device, quantize=quantize)
+        self.cache_size = cache_size
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, sentences, batch_size=32):
+        """
+        Returns the embeddings of sentences, one row per sentence; only sentences not cached are encoded,
+        batch_size at a time.
+        """
+        if not sentences:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        with self.lock:
+            found = {}
+            for sentence in sentences:
+                if sentence in self.vectors:
+                    self.vectors.move_to_end(sentence)
+                    found[sentence] = self.vectors[sentence]
+        missing = [sentence for sentence in dict.fromkeys(sentences) if sentence not in found]
+        if missing:
+            found.update(zip(missing, self.model.encode(missing, batch_size=batch_size)))
+            with self.lock:
+                for sentence in missing:
+                    self.vectors[sentence] = found[sentence]
+                while len(self.vectors) > self.cache_size:
+                    self.vectors.popitem(last=False)
+        return np.stack([found[sentence] for sentence in sentences])
+
+    def pool(self, paragraphs, cache=None):
+        """
+        Returns the unit-norm mean of the sentence vectors of each paragraph, zero for paragraphs without sentences.
+        The sentence spans and vectors of each paragraph are read from and written to cache, a ParagraphCache, if given.
+        """
+        split = split_sentences(paragraphs, cache=cache)
+
+        def compute(indices):
+            sentence_embs = self.encode([sentence for i in indices for sentence in split[i]])
+            offsets = np.cumsum([0] + [len(split[i]) for i in indices])
+            return [sentence_embs[offsets[k]:offsets[k + 1]] for k in range(len(indices))]
+        if cache is None:
+            sentence_embs = compute(range(len(paragraphs)))
+        else:
+            sentence_embs = cache.vectors(self.vectors_namespace, paragraphs, compute)
+        embs = np.zeros((len(paragraphs), self.model.get_sentence_embedding_dimension()))
+        for i, paragraph_embs in enumerate(sentence_embs):
+            if len(paragraph_embs):
+                embs[i] = paragraph_embs.mean(axis=0)
+        magnitude = np.linalg.norm(embs, axis=1, keepdims=True)
+        return np.divide(embs, magnitude, out=np.zeros_like(embs), where=magnitude > 0)
@@ -13,4 +13,9 @@ __all__ = [
 ]
 
 
-from .extractor import ReactionExtractor
\ No newline at end of file
+def __getattr__(name):
+    # transformers and peft are only imported when the extractor is first used
+    if name == "ReactionExtractor":
+        from .extractor import ReactionExtractor
+        return ReactionExtractor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of per-paragraph intermediate results.
+
+Entries are keyed by the sha256 of a namespace, naming the model or pipeline that produced them, and of
+the paragraph text, so an unchanged paragraph (publisher boilerplate repeated across papers, or a corpus
+reprocessed after a config change) is split, tagged and embedded once across runs and processes.
+Sentence spans and keyword hits are stored as json in a sqlite index; embedding vectors are stored as
+float16 rows in memory-mapped files, one file per vector size, the index holding the rows of each entry.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# max number of keys per sqlite query
+_QUERY_SIZE = 500
+
+
+def namespace(*parts):
+    """
+    Returns the namespace of the entries produced by the pipeline described by parts.
+    """
+    return ":".join(str(part) for part in parts)
+
+
+def digest(value):
+    """
+    Returns a short hash of a json-serializable value, such as a keyword list, to use in a namespace.
+    """
+    return hashlib.sha256(json.dumps(value).encode("utf-8")).hexdigest()[:16]
+
+
+class ParagraphCache:
+    """
+    On-disk cache of per-paragraph records and embedding vectors, safe to share between threads and processes.
+
+    Args:
+        path (str): Directory of the cache, created if missing.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.maps = {}
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, dim INTEGER, start INTEGER, count INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS stores (dim INTEGER PRIMARY KEY, rows INTEGER)")
+
+    @staticmethod
+    def key(namespace, text):
+        return hashlib.sha256((namespace + "\0" + text).encode("utf-8")).hexdigest()
+
+    def records(self, namespace, texts, compute):
+        """
+        Returns the json record of each text, calling compute(indices) for the list of records of the texts
+        at indices that are not cached yet, and storing them.
+        """
+        keys = [self.key(namespace, text) for text in texts]
+        found = dict(self._select("SELECT key, value FROM records WHERE key IN ({})", keys))
+        values = [json.loads(found[key]) if key in found else None for key in keys]
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = compute(missing)
+            for i, value in zip(missing, computed):
+                values[i] = value
+            self._db().executemany("INSERT OR REPLACE INTO records VALUES (?, ?)",
+                                   [(keys[i], json.dumps(value)) for i, value in zip(missing, computed)])
+        return values
+
+    def vectors(self, namespace, texts, compute):
+        """
+        Returns the float32 vector matrix of each text, calling compute(indices) for the list of matrices of
+        the texts at indices that are not cached yet, and storing them.
+
+        Vectors are stored as float16, computed ones are returned rounded the same way, so a result
+        does not depend on whether it was cached.
+        """
+        keys = [self.key(namespace, text) for text in texts]
+        found = {key: entry for key, *entry in self._select("SELECT key, dim, start, count FROM vectors WHERE key IN ({})", keys)}
+        matrices = [self._read(*found[key]) if key in found else None for key in keys]
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = [np.asarray(matrix, dtype="<f2") for matrix in compute(missing)]
+            for i, matrix in zip(missing, computed):
+                matrices[i] = matrix.astype(np.float32)
+            self._write([keys[i] for i in missing], computed)
+        return matrices
+
+    def _db(self):
+        # one connection per thread, and a new one in a forked process
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def _select(self, query, keys):
+        rows = []
+        for start in range(0, len(keys), _QUERY_SIZE):
+            chunk = keys[start: start + _QUERY_SIZE]
+            rows += self._db().execute(query.format(",".join("?" * len(chunk))), chunk).fetchall()
+        return rows
+
+    def _store_path(self, dim):
+        return os.path.join(self.path, "vectors-{}.f16".format(dim))
+
+    def _read(self, dim, start, count):
+        with self.lock:
+            store = self.maps.get(dim)
+            if store is None or len(store) < start + count:
+                # the store grew since it was mapped
+                rows = os.path.getsize(self._store_path(dim)) // (2 * dim)
+                store = np.memmap(self._store_path(dim), dtype="<f2", mode="r", shape=(rows, dim)) if rows else None
+                self.maps[dim] = store
+        if count == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        return store[start: start + count].astype(np.float32)
+
+    def _write(self, keys, matrices):
+        db = self._db()
+        entries = []
+        for dim in {matrix.shape[1] for matrix in matrices if matrix.ndim == 2}:
+            group = [(key, matrix) for key, matrix in zip(keys, matrices) if matrix.ndim == 2 and matrix.shape[1] == dim]
+            # reserve the rows in a transaction, so concurrent writers never share rows
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT rows FROM stores WHERE dim = ?", (dim,)).fetchone()
+                start = row[0] if row else 0
+                count = sum(len(matrix) for key, matrix in group)
+                db.execute("INSERT OR REPLACE INTO stores VALUES (?, ?)", (dim, start + count))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            fd = os.open(self._store_path(dim), os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, b"".join(matrix.tobytes() for key, matrix in group), start * dim * 2)
+            finally:
+                os.close(fd)
+            for key, matrix in group:
+                entries.append((key, dim, start, len(matrix)))
+                start += len(matrix)
+        # the rows are indexed once they are written, so readers never see a partial entry
+        db.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?, ?)", entries)
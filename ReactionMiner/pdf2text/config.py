@@ -2,3 +2,12 @@ defaultDir = ""  # default directory to store the PDF to be parsed
 tabWidth = 10
 lineHeight = 12
 threshhold_value = 0.12
+workers = 1  # number of pdf files parsed in parallel by parseFolder
+sscraperBatchSize = 16  # number of pdf files converted by a single SymbolScraper run
+sscraperTimeout = 300  # seconds allowed per pdf file before SymbolScraper is killed
+cleanModelName = "sentence-transformers/all-mpnet-base-v2"  # encoder used by postprocess to filter noise paragraphs
+cleanBatchSize = 32  # paragraphs encoded per forward pass when filtering noise paragraphs
+sharedEncoder = None  # sentence encoder shared with TopicSegmentor(shared_encoder=True) instead of mpnet, e.g. "allenai-specter"; threshhold_value may need tuning
+cleanQuantize = False  # run the noise filter encoder on CPU with int8 linear layers, see ReactionMiner/quantization.py
+paragraphCache = False  # keep paragraph embeddings (float16) in cache/paragraphs/, reused across papers and config changes
+cacheSizeLimit = 2 * 1024 ** 3  # bytes kept in the cache/ directory before least recently used artifacts are evicted
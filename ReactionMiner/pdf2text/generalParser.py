@@ -1,158 +1,364 @@
+import asyncio
 import getopt
 import json
 import os
 import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from .. import registry
+from ..embedding_pool import available_cores
 from . import config
-from .helpers import fileIOHelper, logHelper, pdfToXmlHelper, xmlToJsonHelper
-from .postprocess import cleanJson
+from .helpers import cacheHelper, fileIOHelper, logHelper, pdfToXmlHelper, xmlToJsonHelper
+from .postprocess import cleanData
 
 projectPath = os.path.dirname(os.path.abspath(__file__))
+# single thread cleaning the documents of parseFileAsync when the caller gives no executor for it
+sharedCleanExecutor = None
 
 
-def parseFile(pdfPath: str, logging=False):
+def parseFile(pdfPath: str, logging=False, persist=True):
     # given a path to a pdf file, parse the pdf file and output a json file
     # both symbol scraper and xml parser are run
+    # artifacts of every step are cached by pdf content and step configuration (see cacheHelper)
+    # with persist=False the raw and clean json are only passed around in memory: nothing but the
+    # SymbolScraper xml is written, and the clean json is returned without being saved to results/
 
-    # check if pdf file exists
-    if not os.path.exists(pdfPath):
-        print("Error: File does not exist:", pdfPath)
+    job = _startJob(pdfPath)
+    if job == -1:
         return -1
-    pdfPath = os.path.abspath(pdfPath)
-    filename = os.path.basename(pdfPath)[: -len(".pdf")]
-    xmlPath = projectPath + "/xmlFiles/" + filename + ".xml"
-    rawJsonPath = projectPath + "/parsed_raw/" + filename + ".json"
-    cleanJsonPath = projectPath + "/results/" + filename + ".json"
-    pdfDirPath = os.path.dirname(pdfPath)
-    xmlDirPath = os.path.dirname(xmlPath)
-
-    # create xml dir if not exist
-    if not os.path.exists(xmlDirPath):
-        os.mkdir(xmlDirPath)
-
-    # step 1: parse pdf into xml using Symbol Scraper
+    return _parseJob(job, logging, persist)
+
+
+def _parseJob(job, logging=False, persist=True):
+    # run the steps of parseFile for a job of _startJob
+
+    # don't run any step if the clean json is already cached
+    output = _cachedOutput(job)
+    if output is None:
+        # the xml is only needed if the raw json is not cached either
+        rawOutput = _cachedRaw(job)
+        if rawOutput is None:
+            rawOutput = _rawFromPdf(job, persist)
+        if rawOutput is None:
+            # the cached xml was evicted by another worker before it was parsed: SymbolScraper runs again
+            rawOutput = _rawFromPdf(job, persist)
+        if rawOutput is None or rawOutput == -1:
+            return -1
+        output = _cleanRaw(job, rawOutput, persist)
+    return _finishJob(job, output, logging, persist)
+
+
+def _rawFromPdf(job, persist):
+    # step 1 and 2 of parseFile: return the raw json object of the job, -1, or None if the xml was evicted
+    xmlPath = _convertPdf(job)
+    if xmlPath is None:
+        return -1
+    return _parseXml(job, xmlPath, persist)
+
+
+def _convertPdf(job):
+    # step 1 of parseFile: return the path of the xml of the job, or None if SymbolScraper failed
     print("Step 1: Parse PDF into XML using Symbol Scraper")
     # don't run SymbolScraper if xml already parsed
-    if os.path.exists(xmlPath):
+    xmlPath = cacheHelper.lookup("xml", job["xmlKey"])
+    if xmlPath:
         print("XML file already exists:", xmlPath)
-    else:
-        print("Parsing", pdfPath)
-        suppressSymbolScraperOutput = True
-        outputOption = " > /dev/null" if suppressSymbolScraperOutput else ""
-        os.system(projectPath + "/SymbolScraper/bin/sscraper " + pdfPath + " " + xmlDirPath + outputOption)
-        if not os.path.exists(xmlPath):
-            print("Error: SymbolScraper failed to parse", pdfPath)
-            logHelper.errorLog(pdfPath)
+        return xmlPath
+    print("Parsing", job["pdfPath"])
+    converted = cacheHelper.store(
+        "xml", job["xmlKey"], lambda path: pdfToXmlHelper.runSymbolScraper(job["pdfPath"], path)
+    )
+    if not converted:
+        return None
+    xmlPath = cacheHelper.entryPath("xml", job["xmlKey"])
+    print("XML file written to:", xmlPath)
+    return xmlPath
+
+
+async def parseFileAsync(pdfPath: str, logging=False, persist=True, executor=None, cleanExecutor=None):
+    # awaitable parseFile for asyncio applications
+    # SymbolScraper runs as an asyncio subprocess; hashing, cache and file operations and xml parsing are
+    # blocking and run in executor (default: the event loop's default executor)
+    # cleaning runs the encoder model, which must not run two calls at once: it runs in cleanExecutor,
+    # which should have a single thread (default: one thread shared by every call)
+
+    loop = asyncio.get_running_loop()
+    cleanExecutor = cleanExecutor or _sharedCleanExecutor()
+    job = await loop.run_in_executor(executor, _startJob, pdfPath)
+    if job == -1:
+        return -1
+    output = await loop.run_in_executor(executor, _cachedOutput, job)
+    if output is None:
+        rawOutput = await loop.run_in_executor(executor, _cachedRaw, job)
+        if rawOutput is None:
+            rawOutput = await _rawFromPdfAsync(job, persist, executor)
+        if rawOutput is None:
+            # the cached xml was evicted by another worker before it was parsed: SymbolScraper runs again
+            rawOutput = await _rawFromPdfAsync(job, persist, executor)
+        if rawOutput is None or rawOutput == -1:
             return -1
+        output = await loop.run_in_executor(cleanExecutor, _cleanRaw, job, rawOutput, persist)
+    return await loop.run_in_executor(executor, _finishJob, job, output, logging, persist)
+
+
+async def _rawFromPdfAsync(job, persist, executor):
+    # awaitable _rawFromPdf, SymbolScraper runs as an asyncio subprocess
+    loop = asyncio.get_running_loop()
+    print("Step 1: Parse PDF into XML using Symbol Scraper")
+    xmlPath = await loop.run_in_executor(executor, cacheHelper.lookup, "xml", job["xmlKey"])
+    if xmlPath:
+        print("XML file already exists:", xmlPath)
+    else:
+        print("Parsing", job["pdfPath"])
+        tmpPath = await loop.run_in_executor(executor, cacheHelper.tmpEntryPath, "xml", job["xmlKey"])
+        try:
+            if not await pdfToXmlHelper.runSymbolScraperAsync(job["pdfPath"], tmpPath, executor=executor):
+                return -1
+            xmlPath = await loop.run_in_executor(executor, cacheHelper.commit, "xml", job["xmlKey"], tmpPath)
+        finally:
+            # also when the task is cancelled before the commit
+            await loop.run_in_executor(executor, cacheHelper.removeTmp, tmpPath)
         print("XML file written to:", xmlPath)
+    return await loop.run_in_executor(executor, _parseXml, job, xmlPath, persist)
+
+
+def _sharedCleanExecutor():
+    global sharedCleanExecutor
+    if sharedCleanExecutor is None:
+        sharedCleanExecutor = ThreadPoolExecutor(1, thread_name_prefix="pdf2text-clean")
+    return sharedCleanExecutor
+
+
+def _startJob(pdfPath: str):
+    # check the pdf file and compute the cache keys of every step
+    # check if pdf file exists
+    if not os.path.exists(pdfPath):
+        print("Error: File does not exist:", pdfPath)
+        return -1
+    pdfPath = os.path.abspath(pdfPath)
+    job = {"pdfPath": pdfPath, "filename": os.path.basename(pdfPath)[: -len(".pdf")]}
+    job["threshold"] = config.threshhold_value
+    job["xmlKey"] = _xmlKey(pdfPath)
+    job["rawKey"] = cacheHelper.stageKey(job["xmlKey"], "raw")
+    job["cleanKey"] = cacheHelper.stageKey(job["rawKey"], "clean", threshold=job["threshold"])
+    return job
+
+
+def _cachedOutput(job):
+    # return the cached clean json object of the job, or None
+    return _cachedJson("clean", job["cleanKey"], "Clean JSON file already exists:")
 
-    # step 2: parse xml into raw json
+
+def _cachedRaw(job):
+    # return the cached raw json object of the job, or None
+    return _cachedJson("raw", job["rawKey"], "JSON file already exists:")
+
+
+def _cachedJson(stage, key, message):
+    # return the cached json object of a stage, or None
+    # another worker's evict() can remove the entry between the lookup and the read: that is a miss too
+    jsonPath = cacheHelper.lookup(stage, key)
+    if not jsonPath:
+        return None
+    try:
+        with open(jsonPath, "r") as f:
+            output = json.load(f)
+    except FileNotFoundError:
+        return None
+    print(message, jsonPath)
+    return output
+
+
+def _parseXml(job, xmlPath, persist):
+    # step 2 of parseFile: parse the xml of the job into the raw json object, return it, -1, or None if the
+    # xml is gone
     print("Step 2: Parse XML into raw JSON")
-    # don't parse xml if json already exists
-    if os.path.exists(rawJsonPath):
-        print("JSON file already exists:", rawJsonPath)
-    else:
-        parseExitCode = parse(xmlPath)
-        if parseExitCode == -1:
-            print("Error: Parse XML failed, skipping", pdfPath)
-            return -1
+    try:
+        rawOutput = parse(xmlPath, persist=False)
+    except FileNotFoundError:
+        # evicted by another worker since its lookup, a cache miss
+        print("XML file was evicted:", xmlPath)
+        return None
+    if rawOutput == -1:
+        print("Error: Parse XML failed, skipping", job["pdfPath"])
+        # don't keep an xml that does not parse, the pdf is converted again on the next run
+        cacheHelper.discard("xml", job["xmlKey"])
+        logHelper.errorLog(job["pdfPath"])
+        return -1
+    if persist:
+        cacheHelper.store("raw", job["rawKey"], lambda path: fileIOHelper.outputJsonFile(path, rawOutput))
+    return rawOutput
+
 
-    # step 3: clean json
+def _cleanRaw(job, rawOutput, persist):
+    # step 3 of parseFile: clean the raw json object of the job, return the clean json object
     print("Step 3: Clean JSON file")
-    # don't clean json if clean json already exists
-    if os.path.exists(cleanJsonPath):
-        print("Clean JSON file already exists:", cleanJsonPath)
-    else:
-        cleanJson(rawJsonPath)
+    output = cleanData(rawOutput, job["threshold"])
+    if persist:
+        cacheHelper.store("clean", job["cleanKey"], lambda path: fileIOHelper.outputJsonFile(path, output))
+    return output
+
 
-    # clean up useless .md files created by SymbolScraper
-    print('pdfDirPath', pdfDirPath)
-    for file in os.listdir(pdfDirPath):
-        if file.endswith(".md") and file != "README.md":
-            os.remove(pdfDirPath + "/" + file)
+def _finishJob(job, output, logging, persist):
+    # publish the clean json in results/
+    if persist:
+        fileIOHelper.outputCleanJsonFile(job["filename"], output)
 
-    print("Finished parsing", pdfPath, "\n")
+    print("Finished parsing", job["pdfPath"], "\n")
     # write to the end of log.txt with timestamp
     if logging:
-        logHelper.successLog(pdfPath)
+        logHelper.successLog(job["pdfPath"])
 
     # return the clean json object
-    with open(cleanJsonPath, "r") as f:
-        return json.load(f)
+    return output
 
 
-def parseFolder(folderPath: str, logging=False):
+def parseFolder(folderPath: str, logging=False, workers=None):
     # given a path to a folder, recursively parse all pdf files in it
+    # pdf files are converted by SymbolScraper in batches (config.sscraperBatchSize)
+    # with workers > 1 (default: config.workers), batches are parsed in parallel worker processes,
+    # each one running the noise filter model on its own share of the cores
+
+    workers = config.workers if workers is None else workers
+    pdfPaths = fileIOHelper.findPdfFiles(folderPath)
+    # keep every worker busy when there are few files
+    batchSize = max(1, min(config.sscraperBatchSize, -(-len(pdfPaths) // max(workers, 1))))
+    batches = [pdfPaths[i: i + batchSize] for i in range(0, len(pdfPaths), batchSize)]
+    if workers <= 1:
+        for batch in batches:
+            _parseBatchJob(batch, logging=logging)
+        return
+    threads = max(1, len(available_cores()) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(threads,)) as executor:
+        for _ in executor.map(_parseBatchJob, batches, [logging] * len(batches)):
+            pass
+
+
+def _initWorker(threads):
+    # without it, every worker process runs torch on all cores and they oversubscribe the machine
+    registry.set_cpu_threads(threads)
+
+
+def _parseBatchJob(pdfPaths, logging=False):
+    # convert a batch of pdf files with one SymbolScraper run, then parse them one by one
+    # return the number of pdf files parsed successfully
+    jobs = []
+    for pdfPath in pdfPaths:
+        job = _startJob(pdfPath)
+        if job != -1:
+            jobs.append(job)
+    conversions = []
+    for job in jobs:
+        # the xml is evicted first, being the largest artifact, while the json built from it may still be cached
+        cached = (
+            cacheHelper.lookup("clean", job["cleanKey"])
+            or cacheHelper.lookup("raw", job["rawKey"])
+            or cacheHelper.lookup("xml", job["xmlKey"])
+        )
+        if not cached:
+            conversions.append((job["pdfPath"], cacheHelper.entryPath("xml", job["xmlKey"])))
+    failed = set(pdfToXmlHelper.convertPdfs(conversions, batchSize=len(pdfPaths)))
+    cacheHelper.evict()
+    # the jobs are passed on, so every pdf is hashed once
+    return sum(_parseJob(job, logging=logging) != -1 for job in jobs if job["pdfPath"] not in failed)
+
 
-    for item in sorted(os.listdir(folderPath)):
-        itemPath = os.path.join(folderPath, item)
-        if itemPath.endswith(".pdf"):
-            validPath = fileIOHelper.validateFilename(itemPath)
-            parseFile(validPath, logging=logging)
-        elif os.path.isdir(itemPath):
-            validPath = fileIOHelper.validateFilename(itemPath)
-            parseFolder(validPath, logging=logging)
+def _xmlKey(pdfPath: str):
+    return cacheHelper.stageKey(cacheHelper.fileHash(pdfPath), "xml")
 
 
-def parse(inputXml: str, logging=False):
+def parse(inputXml: str, logging=False, outputPath=None, persist=True):
     # given a path to a xml file, parse the xml file and output a json file
+    # the json is written to outputPath, or to parsed_raw/ under the name of the xml file,
+    # unless persist is False; it is returned either way (-1 if the xml can't be parsed)
 
-    pdfToXmlHelper.preParseXML(inputXml)
+    # paragraphs are recorded as [start, end) offsets into fullText, so the text is only assembled once
+    fullText = xmlToJsonHelper.TextBuilder()
+    offsets = []
     try:
-        tree = ET.parse(inputXml)  # improvement: change to argument based input
+        for page in parsePages(inputXml):
+            for lines in page["paragraphs"]:
+                start, paragraphEmpty = len(fullText), True
+                for lineContent in lines:
+                    lineStart = fullText.append(lineContent)
+                    # like updateText, an empty paragraph is replaced by the next line instead of joined with it
+                    if paragraphEmpty:
+                        start, paragraphEmpty = lineStart, not lineContent
+                offsets.append([start, len(fullText)])
     except ET.ParseError:
         print("Error: Parse XML failed, skipping", inputXml)
         if logging:
             logHelper.errorLog(inputXml)
         return -1
-    root = tree.getroot()
 
     output = {}
-    output["fullText"] = ""
-    output["contents"] = []
-
-    paragraphStart = xmlToJsonHelper.findOffset(root)
-
-    for pageXml in root.iter("Page"):
-        prevLineBBOX = None
-        for lineXml in pageXml.iter("Line"):
-            # building line content
-            lineContent = ""
-            lineXMLBBOX = lineXml.attrib["BBOX"]
-            for wordXml in lineXml.iter("Word"):
-                word = xmlToJsonHelper.buildWord(wordXml)
-                lineContent = xmlToJsonHelper.updateText(lineContent, word)
-            lineContent = lineContent.strip()
-
-            # if the line is a graph, skip the rest of the page
-            # fullText will not have the rest of page either
-            if xmlToJsonHelper.checkEndOfPage(lineContent) and xmlToJsonHelper.checkNewParagraph(lineXMLBBOX, prevLineBBOX, paragraphStart):
-                break
-            # update outputs
-            output["fullText"] = xmlToJsonHelper.updateText(output["fullText"], lineContent)
-            if xmlToJsonHelper.checkNewParagraph(lineXMLBBOX, prevLineBBOX, paragraphStart):
-                output["contents"].append(lineContent)
-            else:
-                output["contents"][-1] = xmlToJsonHelper.updateText(output["contents"][-1], lineContent)
-            # update prevLineBBOX
-            if xmlToJsonHelper.checkSameLine(lineXMLBBOX, prevLineBBOX):
-                prevLineBBOX = xmlToJsonHelper.combineLines(lineXMLBBOX, prevLineBBOX)
-            else:
-                prevLineBBOX = lineXMLBBOX
+    output["fullText"] = fullText.build()
+    output["contents"] = [output["fullText"][start:end] for start, end in offsets]
+    output["offsets"] = offsets
     # output raw json file
-    filename = os.path.basename(inputXml)[: -len(".xml")]
-    fileIOHelper.outputDirtyJsonFile(filename, output)
+    if persist and outputPath:
+        fileIOHelper.outputJsonFile(outputPath, output)
+    elif persist:
+        filename = os.path.basename(inputXml)[: -len(".xml")]
+        fileIOHelper.outputDirtyJsonFile(filename, output)
+    return output
+
+
+def parsePages(inputXml: str):
+    # given a path to a xml file, yield one record per page
+    # each record is {"page": index, "paragraphs": [[line, ...], ...]}
+    # the xml is streamed once, never loaded as a whole tree, and sanitized on the fly instead of being
+    # rewritten on disk first; the line texts and bbox arrays of every page (bounded by the size of the
+    # output) are kept until the paragraph start offsets of the whole document are known
+
+    pages = []
+    with pdfToXmlHelper.SanitizedXML(inputXml) as source:
+        for pageXml in xmlToJsonHelper.iterPages(source):
+            # building line contents, each BBOX is parsed once per page
+            lineContents = []
+            lineBBOXes = []
+            for lineXml in pageXml.iter("Line"):
+                lineContent = xmlToJsonHelper.TextBuilder()
+                for wordXml in lineXml.iter("Word"):
+                    lineContent.append(xmlToJsonHelper.buildWord(wordXml))
+                lineContents.append(lineContent.build().strip())
+                lineBBOXes.append(lineXml.attrib["BBOX"])
+            pages.append((lineContents, xmlToJsonHelper.bboxArray(lineBBOXes)))
+
+    paragraphStart = xmlToJsonHelper.findOffsetX(xMin for _, bboxes in pages for xMin in bboxes[:, 0].tolist())
+    for pageIndex, (lineContents, bboxes) in enumerate(pages):
+        yield {"page": pageIndex, "paragraphs": _pageParagraphs(lineContents, bboxes, paragraphStart)}
+
+
+def _pageParagraphs(lineContents, bboxes, paragraphStart):
+    newParagraphs = xmlToJsonHelper.newParagraphMask(bboxes, paragraphStart)
+    paragraphs = []
+    for lineContent, newParagraph in zip(lineContents, newParagraphs):
+        # if the line is a graph, skip the rest of the page
+        # fullText will not have the rest of page either
+        if newParagraph and xmlToJsonHelper.checkEndOfPage(lineContent):
+            break
+        # the first line of a page always starts a new paragraph
+        if newParagraph:
+            paragraphs.append([lineContent])
+        else:
+            paragraphs[-1].append(lineContent)
+    return paragraphs
 
 
 # main function
 if __name__ == "__main__":
     argv = sys.argv[1:]
     inputfile = ""
-    opts, args = getopt.getopt(argv, "hcli:")
+    opts, args = getopt.getopt(argv, "hcli:j:")
+    for opt, arg in opts:
+        if opt == "-j":
+            config.workers = int(arg)
     for opt, arg in opts:
         if opt == "-h":
             print("[Usage]: python3 generalParser.py -i <inputPDF>")
+            print("         python3 generalParser.py [-l] [-j <workers>]")
             print("Result will be saved as a .json file in the results/ folder")
             sys.exit()
         elif opt == "-i":
@@ -164,6 +370,6 @@ if __name__ == "__main__":
             target_dir = os.path.join(projectPath, config.defaultDir)
             logHelper.logHeader()
             parseFolder(target_dir, logging=True)
-    if not opts:
+    if not [opt for opt, arg in opts if opt != "-j"]:
         target_dir = os.path.join(projectPath, config.defaultDir)
         parseFolder(target_dir)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+from .. import config
+
+projectPath = os.path.dirname(os.path.abspath(__file__)) + "/../"
+cacheDirPath = projectPath + "/cache/"
+# per-paragraph results, see ReactionMiner.paragraph_cache; kept out of the LRU eviction of stage artifacts
+paragraphCacheDirPath = cacheDirPath + "paragraphs/"
+
+# bump the version of a stage whenever its code changes the artifact it produces
+stageVersions = {
+    "xml": 1,  # SymbolScraper output
+    "raw": 1,  # xml parsed into raw json
+    "clean": 1,  # raw json cleaned by postprocess
+}
+stageExtensions = {"xml": ".xml", "raw": ".json", "clean": ".json"}
+
+# running total of the cache size in bytes, so commit() only scans the cache when it may be over its limit
+# (None until the first scan); entries written by other processes are counted by the next scan
+cacheSize = None
+cacheSizeLock = threading.Lock()
+
+
+def fileHash(path):
+    # given a path to a file, return the sha256 hex digest of its content
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stageParams(stage, threshold=None):
+    # everything besides the input that changes the artifact of a stage
+    params = {"version": stageVersions[stage]}
+    if stage == "raw":
+        params["tabWidth"] = config.tabWidth
+        params["lineHeight"] = config.lineHeight
+    elif stage == "clean":
+        params["threshold"] = config.threshhold_value if threshold is None else threshold
+        params["model"] = config.sharedEncoder or config.cleanModelName
+        params["quantize"] = config.cleanQuantize
+        params["paragraphCache"] = config.paragraphCache
+    return params
+
+
+def stageKey(parentKey, stage, **kwargs):
+    # key of the artifact a stage produces from the artifact (or pdf content hash) parentKey
+    payload = json.dumps([parentKey, stage, stageParams(stage, **kwargs)], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def entryPath(stage, key):
+    stageDirPath = cacheDirPath + stage + "/"
+    os.makedirs(stageDirPath, exist_ok=True)
+    return stageDirPath + key + stageExtensions[stage]
+
+
+def lookup(stage, key):
+    # return the path of the cached artifact, or None on a miss
+    # a hit refreshes the entry's mtime, which is what the LRU eviction orders by
+    path = entryPath(stage, key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def store(stage, key, writer):
+    # create a cache entry: writer(tmpPath) writes the artifact to tmpPath and returns a status,
+    # the file is then moved into place atomically, so concurrent workers never see partial entries
+    # return the status returned by writer
+    tmpPath = tmpEntryPath(stage, key)
+    try:
+        status = writer(tmpPath)
+        commit(stage, key, tmpPath)
+    finally:
+        removeTmp(tmpPath)
+    return status
+
+
+def tmpEntryPath(stage, key):
+    # private path to write an entry to before commit()
+    return entryPath(stage, key) + "." + uuid.uuid4().hex + ".tmp"
+
+
+def removeTmp(tmpPath):
+    # remove an entry written to tmpPath that was not committed; evict() never removes .tmp files
+    try:
+        os.remove(tmpPath)
+    except FileNotFoundError:
+        pass
+
+
+def commit(stage, key, tmpPath):
+    # move an entry written to tmpPath into place, if it was written, and keep the cache within its limit
+    global cacheSize
+    path = entryPath(stage, key)
+    if os.path.exists(tmpPath):
+        size = os.path.getsize(tmpPath)
+        os.replace(tmpPath, path)
+        with cacheSizeLock:
+            if cacheSize is not None:
+                cacheSize += size
+            scan = cacheSize is None or cacheSize > config.cacheSizeLimit
+        if scan:
+            evict(keep=path)
+    return path
+
+
+def discard(stage, key):
+    # remove a cache entry, e.g. an artifact found to be unusable, so the step producing it runs again
+    global cacheSize
+    try:
+        size = os.path.getsize(entryPath(stage, key))
+        os.remove(entryPath(stage, key))
+    except FileNotFoundError:
+        return
+    with cacheSizeLock:
+        if cacheSize is not None:
+            cacheSize -= size
+
+
+def evict(limit=None, keep=None):
+    # remove the least recently used entries until the cache is within limit bytes (config.cacheSizeLimit)
+    global cacheSize
+    limit = config.cacheSizeLimit if limit is None else limit
+    entries = []
+    total = 0
+    for stage in stageVersions:
+        stageDirPath = cacheDirPath + stage + "/"
+        if not os.path.isdir(stageDirPath):
+            continue
+        for entry in os.scandir(stageDirPath):
+            # skip SymbolScraper scratch directories and entries being written
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    for mtime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if os.path.abspath(path) == os.path.abspath(keep or ""):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    with cacheSizeLock:
+        cacheSize = total
@@ -8,8 +8,7 @@ projectPath = os.path.dirname(os.path.abspath(__file__)) + "/../"
 def outputDirtyJsonFile(filename, output):
     outputFileName = filename + ".json"
     rawJsonDirPath = projectPath + "/parsed_raw/"
-    if not os.path.exists(rawJsonDirPath):
-        os.mkdir(rawJsonDirPath)
+    os.makedirs(rawJsonDirPath, exist_ok=True)
     outputFilePath = rawJsonDirPath + outputFileName
     with open(outputFilePath, "w") as outfile:
         json.dump(output, outfile, indent=4, ensure_ascii=False)
@@ -20,8 +19,7 @@ def outputDirtyJsonFile(filename, output):
 def outputCleanJsonFile(filename, output):
     outputFileName = filename + ".json"
     result_directory = projectPath + "/results/"
-    if not os.path.exists(result_directory):
-        os.mkdir(result_directory)
+    os.makedirs(result_directory, exist_ok=True)
     outputFilePath = result_directory + outputFileName
     with open(outputFilePath, "w") as outfile:
         json.dump(output, outfile, indent=4, ensure_ascii=False)
@@ -29,6 +27,12 @@ def outputCleanJsonFile(filename, output):
     return outputFilePath
 
 
+def outputJsonFile(outputFilePath, output):
+    with open(outputFilePath, "w") as outfile:
+        json.dump(output, outfile, indent=4, ensure_ascii=False)
+    return outputFilePath
+
+
 def validateFilename(inputfile: str):
     # given a path, make sure the path is valid (rename if needed)
     # valid path is returned
@@ -37,11 +41,31 @@ def validateFilename(inputfile: str):
     return newFilename
 
 
+def findPdfFiles(folderPath: str):
+    # given a path to a folder, return the valid paths of all pdf files in it and its subfolders
+    # folders are scanned iteratively, each one listed exactly once
+
+    pdfPaths = []
+    pendingFolders = [folderPath]
+    while pendingFolders:
+        folder = pendingFolders.pop()
+        subFolders = []
+        for item in sorted(os.listdir(folder)):
+            itemPath = os.path.join(folder, item)
+            if itemPath.endswith(".pdf"):
+                pdfPaths.append(validateFilename(itemPath))
+            elif os.path.isdir(itemPath):
+                subFolders.append(validateFilename(itemPath))
+        pendingFolders.extend(reversed(subFolders))
+    return pdfPaths
+
+
 def cleanFolders():
     # clear everything in the xml and result folder
     xml_directory = projectPath + "/xmlFiles/"
     result_directory = projectPath + "/parsed_raw/"
     final_result_directory = projectPath + "/results/"
+    cache_directory = projectPath + "/cache/"
     logPath = projectPath + '/log.txt'
     errorLogPath = projectPath + '/errorLog.txt'
     if os.path.exists(xml_directory):
@@ -50,6 +74,8 @@ def cleanFolders():
         shutil.rmtree(result_directory)
     if os.path.exists(final_result_directory):
         shutil.rmtree(final_result_directory)
+    if os.path.exists(cache_directory):
+        shutil.rmtree(cache_directory)
     if os.path.exists(logPath):
         os.remove(logPath)
     if os.path.exists(errorLogPath):
@@ -1,20 +1,256 @@
+import asyncio
+import functools
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+from .. import config
+from . import logHelper
+
+projectPath = os.path.dirname(os.path.abspath(__file__)) + "/../"
+sscraperPath = projectPath + "/SymbolScraper/bin/sscraper"
+
+invalidXmlEntities = [  # applied in this order, each one as a full replace pass in the original preParseXML
+    (">&<", ">&amp;<"),
+    ("><<", ">&lt;<"),
+    (">><", ">&gt;<"),
+]
+# remove all ascii control characters that are not tab, newline, or carriage return
+# (a regex, str.translate with a deletion table is several times slower on large chunks)
+invalidAsciiPattern = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+# seconds between two checks of the xml files a running SymbolScraper batch has written
+scratchPollInterval = 0.5
+
+
+class SanitizedXML:
+    # file-like wrapper around an xml file generated by SymbolScraper
+    # the text returned by read() is the file content made valid, cleaned chunk by chunk in a single pass,
+    # so it can be handed straight to the xml parser without rewriting the file
+
+    def __init__(self, path, chunkSize=1 << 16):
+        self.file = open(path, "r")
+        self.chunkSize = chunkSize
+        self.pending = ""  # raw text held back because an entity fix could span the chunk boundary
+        self.buffer = ""  # cleaned text not returned yet
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fill(self):
+        chunk = self.file.read(self.chunkSize)
+        text = self.pending + chunk
+        if not chunk:
+            self.eof = True
+            cut = len(text)
+        else:
+            # every entity fix starts with ">", and ">><" is the only one with ">" further in,
+            # so no fix can span a cut made right before a run of ">"
+            cut = text.rfind(">")
+            while cut > 0 and text[cut - 1] == ">":
+                cut -= 1
+            if cut <= 0:
+                self.pending = text
+                return
+        self.pending = text[cut:]
+        self.buffer += sanitize(text[:cut])
+
+
+def runSymbolScraper(pdfPath, xmlPath, suppressOutput=True):
+    # given a path to a pdf file, convert it with SymbolScraper and move the xml to xmlPath
+    # return True if the xml was written
+    return not convertPdfs([(pdfPath, xmlPath)], suppressOutput=suppressOutput)
+
+
+def convertPdfs(jobs, batchSize=None, timeout=None, suppressOutput=True):
+    # given a list of (pdfPath, xmlPath) pairs, convert the pdf files with SymbolScraper
+    # pdf files are submitted in batches to a single SymbolScraper run, so the JVM starts once per batch
+    # a batch is killed once it spends timeout seconds on one pdf; when a run stops early (timeout or crash),
+    # the document that stopped it is given up or retried alone, and the documents it did not convert after
+    # it are restarted as one new batch; documents given up are written to the error log
+    # return the list of pdf paths that could not be converted
+    batchSize = config.sscraperBatchSize if batchSize is None else batchSize
+    timeout = config.sscraperTimeout if timeout is None else timeout
+    failed = []
+    for i in range(0, len(jobs), batchSize):
+        batch = jobs[i: i + batchSize]
+        while batch:
+            remaining, started, timedOut = _convertBatch(batch, timeout, suppressOutput)
+            if not remaining:
+                break
+            # the document that stopped the run is the one whose xml was left unfinished, or else the first
+            # one not converted in batch order; if that guess is wrong, the next run stops on the right one
+            culprit = started or remaining[0]
+            # a document SymbolScraper hung on has had its timeout, any other gets one run of its own
+            givenUp = len(batch) == 1 or (timedOut and culprit is started)
+            if givenUp or _convertBatch([culprit], timeout, suppressOutput)[0]:
+                print("Error: SymbolScraper failed to parse", culprit[0])
+                logHelper.errorLog(culprit[0])
+                failed.append(culprit[0])
+            batch = [job for job in remaining if job is not culprit]
+    return failed
+
+
+def _convertBatch(batch, timeout, suppressOutput):
+    # run SymbolScraper once over a private scratch directory holding the whole batch
+    # return the jobs whose xml was not written, the one of them whose xml was started but not finished
+    # (or None), and whether the run was killed for taking more than timeout seconds on one pdf
+    scratchDir, scratchNames, command = _prepareScratch(batch)
+    try:
+        output = subprocess.DEVNULL if suppressOutput else None
+        # run in its own session, so a timeout kills the JVM and not only the launcher script
+        process = subprocess.Popen(command, stdout=output, start_new_session=True)
+        # every pdf gets timeout seconds: the deadline moves each time a new xml appears in the scratch directory
+        converted = 0
+        deadline = time.monotonic() + timeout
+        timedOut = False
+        while process.poll() is None:
+            written = _countScratch(scratchDir, scratchNames)
+            if written > converted:
+                converted, deadline = written, time.monotonic() + timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print("Error: SymbolScraper timed out, killing it")
+                _killGroup(process)
+                process.wait()
+                timedOut = True
+                break
+            try:
+                process.wait(timeout=min(scratchPollInterval, remaining))
+            except subprocess.TimeoutExpired:
+                pass
+        remaining = _collectScratch(batch, scratchDir, scratchNames)
+        # the xml files left in the scratch directory are the unfinished ones
+        started = [job for scratchName, job in zip(scratchNames, batch)
+                   if job in remaining and os.path.exists(os.path.join(scratchDir, scratchName + ".xml"))]
+        return remaining, (started[0] if started else None), timedOut
+    finally:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+
+async def runSymbolScraperAsync(pdfPath, xmlPath, timeout=None, suppressOutput=True, executor=None):
+    # awaitable runSymbolScraper: SymbolScraper runs as an asyncio subprocess, so the event loop keeps
+    # serving other documents while the JVM works; the scratch directory is prepared, collected and
+    # removed in executor (default: the event loop's default executor)
+    # return True if the xml was written
+    timeout = config.sscraperTimeout if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    batch = [(pdfPath, xmlPath)]
+    scratchDir, scratchNames, command = await loop.run_in_executor(executor, _prepareScratch, batch)
+    process = None
+    try:
+        output = asyncio.subprocess.DEVNULL if suppressOutput else None
+        process = await asyncio.create_subprocess_exec(*command, stdout=output, start_new_session=True)
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            # the xml it was writing is unfinished, nothing is collected
+            print("Error: SymbolScraper timed out, killing it")
+            _killGroup(process)
+            await process.wait()
+            print("Error: SymbolScraper failed to parse", pdfPath)
+            logHelper.errorLog(pdfPath)
+            return False
+        if await loop.run_in_executor(executor, _collectScratch, batch, scratchDir, scratchNames):
+            print("Error: SymbolScraper failed to parse", pdfPath)
+            logHelper.errorLog(pdfPath)
+            return False
+        return True
+    finally:
+        # when the awaiting task is cancelled, the JVM is still running: kill it before removing its scratch directory
+        if process is not None and process.returncode is None:
+            _killGroup(process)
+            await process.wait()
+        await loop.run_in_executor(executor, functools.partial(shutil.rmtree, scratchDir, ignore_errors=True))
+
+
+def _prepareScratch(batch):
+    # link the pdf files of a batch into a private scratch directory next to their xml files,
+    # so concurrent jobs never share SymbolScraper output paths, and the .md files it drops are
+    # removed with the directory
+    # return the scratch directory, the name of each pdf in it and the SymbolScraper command
+    xmlDirPath = os.path.dirname(batch[0][1])
+    os.makedirs(xmlDirPath, exist_ok=True)
+    scratchDir = tempfile.mkdtemp(prefix=".scratch-", dir=xmlDirPath)
+    scratchNames = []
+    for index, (pdfPath, xmlPath) in enumerate(batch):
+        # prefix with the batch index, pdf files from different folders may share a basename;
+        # zero-padded, so the scratch directory lists the pdf files in batch order
+        scratchName = str(index).zfill(len(str(len(batch) - 1))) + "_" + os.path.splitext(os.path.basename(pdfPath))[0]
+        os.symlink(os.path.abspath(pdfPath), os.path.join(scratchDir, scratchName + ".pdf"))
+        scratchNames.append(scratchName)
+    scratchInput = os.path.join(scratchDir, scratchNames[0] + ".pdf") if len(batch) == 1 else scratchDir
+    return scratchDir, scratchNames, [sscraperPath, scratchInput, scratchDir]
+
+
+def _killGroup(process):
+    # kill SymbolScraper with the JVM it started; the group may have exited since the timeout
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _countScratch(scratchDir, scratchNames):
+    # number of the pdf files of a batch whose xml SymbolScraper has started writing
+    return sum(os.path.exists(os.path.join(scratchDir, scratchName + ".xml")) for scratchName in scratchNames)
+
+
+def _collectScratch(batch, scratchDir, scratchNames):
+    # move the xml files SymbolScraper finished writing in the scratch directory to their destination
+    # an xml cut short by a kill or a crash is left to be removed with the directory
+    # return the jobs whose xml was not written
+    remaining = []
+    for scratchName, job in zip(scratchNames, batch):
+        scratchXmlPath = os.path.join(scratchDir, scratchName + ".xml")
+        if os.path.exists(scratchXmlPath) and xmlComplete(scratchXmlPath):
+            os.replace(scratchXmlPath, job[1])
+        else:
+            remaining.append(job)
+    return remaining
+
+
+def xmlComplete(path, tailSize=1024):
+    # given a path to an xml file, check that it ends with the closing tag of its root element,
+    # which an xml SymbolScraper did not finish writing does not
+    with open(path, "rb") as file:
+        root = re.search(rb"<([A-Za-z_][\w.:-]*)", file.read(4096))
+        file.seek(max(0, os.path.getsize(path) - tailSize))
+        tail = file.read().rstrip()
+    return root is not None and tail.endswith(b"</" + root.group(1) + b">")
+
+
+def sanitize(filedata):
+    # replace all invalid xml characters with valid ones
+    for invalid, valid in invalidXmlEntities:
+        filedata = filedata.replace(invalid, valid)
+    return invalidAsciiPattern.sub("", filedata)
+
 
 def preParseXML(path):
     # given a path to an xml file, modify the file to make it a valid xml file
-    with open(path, "r") as file:
-        filedata = file.read()
-    # replace all invalid xml characters with valid ones
-    filedata = filedata.replace(">&<", ">&amp;<")
-    filedata = filedata.replace("><<", ">&lt;<")
-    filedata = filedata.replace(">><", ">&gt;<")
-    filedata = filedata.replace(chr(0), "")
-    filedata = filedata.replace("", "")
-    # remove all ascii characters that are not tab, newline, or carriage return
-    for invalidAscii in range(1, 31):
-        if invalidAscii == 9 or invalidAscii == 10 or invalidAscii == 13:
-            continue   # tab, newline, carriage return
-        char = chr(invalidAscii)
-        filedata = filedata.replace(char, "")
+    # parsing does not need this anymore, SanitizedXML cleans the xml while it is read
+    with SanitizedXML(path) as source:
+        filedata = source.read()
     # write the modified xml file back to the original path
     with open(path, "w") as file:
         file.write(filedata)
@@ -1,5 +1,8 @@
 import collections
 import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
 
 from .. import config
 
@@ -37,24 +40,75 @@ def updateText(inputObject, word):
     return inputObject
 
 
+class TextBuilder:
+    # linear-time replacement for folding updateText over many words or lines
+    # pieces are collected in a list and joined once instead of re-copying the text on every +=
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.lastChar = ""
+
+    def __len__(self):
+        return self.length
+
+    def append(self, word):
+        # add the word with the same joining rule as updateText, return the offset the word starts at
+        if self.length:
+            # don't join with space if the text ends with a hyphen
+            if self.lastChar != "-":
+                self.parts.append(" ")
+                self.length += 1
+                self.lastChar = " "
+        start = self.length
+        if word:
+            self.parts.append(word)
+            self.length += len(word)
+            self.lastChar = word[-1]
+        return start
+
+    def build(self):
+        text = "".join(self.parts)
+        self.parts = [text] if text else []
+        return text
+
+
 def buildWord(wordXml):
     # given an word xml element, return the word as a input_string
 
-    wordBuf = ""
+    chars = []
     for char in wordXml.iter("Char"):
-        wordBuf += (
-            weirdChar[str(char.text)] if char.text in weirdChar else str(
-                char.text)
-        )
-    return wordBuf
+        text = str(char.text)
+        chars.append(weirdChar.get(text, text))
+    return "".join(chars)
+
 
+def iterPages(source):
+    # given a path to (or a file object of) a xml file, yield its Page elements one at a time
+    # every page is cleared once consumed, so memory is bounded by the largest page
 
-def findOffset(root):
+    context = iter(ET.iterparse(source, events=("start", "end")))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == "Page":
+            yield elem
+            elem.clear()
+            root.clear()
+
+
+def findOffset(lines):
     # find the two most common line start positions
+    # lines is any iterable of Line elements, e.g. root.iter("Line")
+
+    return findOffsetX(float(lineXml.attrib["BBOX"].split(" ")[0]) for lineXml in lines)
+
+
+def findOffsetX(xMins):
+    # findOffset given the xMin of every line instead of the Line elements
 
     lineStartPos = collections.defaultdict(int)
-    for lineXml in root.iter("Line"):
-        location = round(float(lineXml.attrib["BBOX"].split(" ")[0]))
+    for xMin in xMins:
+        location = round(xMin)
         lineStartPos[location] += 1
     twoMean = sorted(lineStartPos.items(),
                      key=lambda x: x[1], reverse=True)[:2]
@@ -154,6 +208,50 @@ def combineLines(line1BBOX, line2BBOX):
     return bbox
 
 
+def bboxArray(bboxes):
+    # given a list of BBOX strings, parse them once into a (n, 4) float array of xMin, yMin, xMax, yMax
+
+    return np.array([[float(v) for v in bbox.split(" ")] for bbox in bboxes], dtype=np.float64).reshape(-1, 4)
+
+
+def newParagraphMask(bboxes, offsets):
+    # vectorised checkNewParagraph for all lines of a page, given their (n, 4) bbox array
+    # mask[i] is what checkNewParagraph(line i, prevLineBBOX, offsets) returns in the line by line loop,
+    # where prevLineBBOX is line i-1 combined (combineLines) with the same-line run it belongs to
+
+    n = len(bboxes)
+    mask = np.ones(n, dtype=bool)
+    if n < 2:
+        return mask
+    xMin, yMin = bboxes[:, 0], bboxes[:, 1]
+    # lines on the same y as the line before them are merged into it
+    mergedIntoPrev = np.zeros(n, dtype=bool)
+    mergedIntoPrev[1:] = np.abs(yMin[1:] - yMin[:-1]) < 5
+    # xMin of the merged bbox is the running min over its run, yMin is always the last line's
+    prevXMin = xMin.copy()
+    runStart = np.flatnonzero(~mergedIntoPrev)
+    posInRun = np.arange(n) - np.repeat(runStart, np.diff(np.append(runStart, n)))
+    for step in range(1, posInRun.max() + 1):
+        idx = np.flatnonzero(posInRun == step)
+        prevXMin[idx] = np.minimum(xMin[idx], prevXMin[idx - 1])
+
+    xCurr, yCurr = xMin[1:], yMin[1:]
+    xPrev, yPrev = prevXMin[:-1], yMin[:-1]
+    dx, dy = xCurr - xPrev, yCurr - yPrev
+    sameLine = np.abs(dy) < 5
+    linesFar = (np.abs(dx) > 20) | (np.abs(dy) > 20)
+    sameStartX = np.abs(dx) < 5
+    indented = (xCurr > xPrev) & (np.abs(dx - tabWidth) < 5) & (np.abs(dy - lineHeight) < 5)
+    twoColumns = (np.abs(xCurr - max(offsets)) < 10) & (np.abs(xPrev - min(offsets)) < 10)
+    startParagraph = (np.abs(xCurr - tabWidth - offsets[0]) < 5) | (np.abs(xCurr - tabWidth - offsets[1]) < 5)
+    mask[1:] = (
+        ~sameLine
+        & ~(sameStartX & ~linesFar)
+        & (indented | (linesFar & ~twoColumns) | startParagraph)
+    )
+    return mask
+
+
 def roughEqual(a, b, threshold):
     # check if two numbers are roughly equal
     return abs(a - b) < threshold
@@ -1,67 +1,116 @@
 import json
-import math
 import os
 
 import numpy as np
-import torch
-from transformers import AutoModel, AutoTokenizer
 
-from .helpers.fileIOHelper import outputCleanJsonFile
+from .. import registry
+from ..paragraph_cache import namespace
+from . import config
+from .helpers.cacheHelper import paragraphCacheDirPath
+from .helpers.fileIOHelper import outputCleanJsonFile, outputJsonFile
 from .config import threshhold_value
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# the pretrained model is loaded on first use, see ReactionMiner.registry
+# the encoder settings (cleanModelName, cleanBatchSize, cleanQuantize) are read from config on every call
 
-# import pretrained model
-mpnet_tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/all-mpnet-base-v2")
-mpnet_model = AutoModel.from_pretrained("sentence-transformers/all-mpnet-base-v2", output_hidden_states=True).to(device)
+
+def mpnet(quantize=None):
+    quantize = config.cleanQuantize if quantize is None else quantize
+    return registry.transformer(config.cleanModelName, quantize=quantize, output_hidden_states=True)
+
+
+def __getattr__(name):
+    # module attributes of the eagerly loaded model, kept for backward compatibility
+    if name == "device":
+        return registry.torch_device()
+    if name == "mpnet_tokenizer":
+        return mpnet()[0]
+    if name == "mpnet_model":
+        return mpnet()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # driver function
 # clean noise information
 
 
-def cleanJson(jsonPath, threshold=threshhold_value):
+def cleanJson(jsonPath, threshold=threshhold_value, outputPath=None):
     with open(jsonPath) as fin:
         contents = fin.read()
         # Strip any leading/trailing whitespace
         contents = contents.strip()
         # Parse the JSON data
         data = json.loads(contents)
-        jsonContents = data["contents"]
-    cleaned_paragraphs = clean_paragraphs(jsonContents, threshold)
-    complete_paragraphs = concat_paragraphs(cleaned_paragraphs)
-    data["contents"] = complete_paragraphs
-    filename = os.path.basename(jsonPath)[: -len(".json")]
-    outputCleanJsonFile(filename, data)
-    return complete_paragraphs
+    data = cleanData(data, threshold)
+    if outputPath:
+        outputJsonFile(outputPath, data)
+    else:
+        filename = os.path.basename(jsonPath)[: -len(".json")]
+        outputCleanJsonFile(filename, data)
+    return data["contents"]
 
-# obtain paragraph embedding
+# clean a raw json object in memory, return the clean json object
 
 
-def mpnet_emb(text):
-    input_ids = (torch.tensor(mpnet_tokenizer.encode(text.lower(), max_length=512, truncation=True)).unsqueeze(0).to(device))
-    input_ids = input_ids[:, :512]
-    outputs = mpnet_model(input_ids)
-    hidden_states = outputs[2][-1][0]
-    emb = torch.mean(hidden_states, dim=0).to(device)
-    emb = np.array([float(x) for x in emb])
-    magnitude = np.linalg.norm(emb)
-    if math.isnan(magnitude):
-        emb = np.zeros(len(emb))
-    else:
-        emb = emb / magnitude
-    return emb
+def cleanData(data, threshold=threshhold_value):
+    cleaned_paragraphs = clean_paragraphs(data["contents"], threshold)
+    complete_paragraphs = concat_paragraphs(cleaned_paragraphs)
+    # cleaned paragraphs are filtered and concatenated, they are no longer slices of fullText
+    data = {key: value for key, value in data.items() if key != "offsets"}
+    data["contents"] = complete_paragraphs
+    return data
+
+# obtain the embeddings of many paragraphs, in length-sorted padded batches
+
+
+def mpnet_emb_batch(texts, batch_size=None, quantize=None):
+    import torch
+    batch_size = config.cleanBatchSize if batch_size is None else batch_size
+    mpnet_tokenizer, mpnet_model = mpnet(quantize)
+    device = mpnet_model.device
+    input_ids = mpnet_tokenizer([text.lower() for text in texts], max_length=512, truncation=True)["input_ids"]
+    # sort by token count so each batch is padded as little as possible
+    order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+    embs = np.zeros((len(texts), mpnet_model.config.hidden_size))
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start: start + batch_size]
+            batch = mpnet_tokenizer.pad({"input_ids": [input_ids[i] for i in batch_ids]}, return_tensors="pt").to(device)
+            outputs = mpnet_model(**batch)
+            hidden_states = outputs[2][-1]
+            # mean over the tokens of each text, padding excluded
+            mask = batch["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+            emb = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+            embs[batch_ids] = emb.float().cpu().numpy()
+    magnitude = np.linalg.norm(embs, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        embs = embs / magnitude
+    embs[np.isnan(magnitude[:, 0])] = 0
+    return embs
+
+# obtain the embeddings of many paragraphs with the configured encoder:
+# mpnet, or the unit-norm mean of the sentence vectors of the shared encoder
+# with paragraphCache, embeddings are read from and written to the paragraph cache
+# the encoder settings are read from config on every call, as TopicSegmentor(shared_encoder=True) and the cache keys do,
+# so the vectors are cached under the model that computed them
+
+
+def paragraph_emb_batch(texts):
+    cache = registry.paragraph_cache(paragraphCacheDirPath) if config.paragraphCache else None
+    if config.sharedEncoder:
+        return registry.shared_encoder(config.sharedEncoder, quantize=config.cleanQuantize).pool(texts, cache=cache)
+    if cache is None:
+        return mpnet_emb_batch(texts)
+    vectors_namespace = namespace("paragraph_vectors", config.cleanModelName, "int8" if config.cleanQuantize else "fp32")
+    vectors = cache.vectors(vectors_namespace, texts, lambda indices: mpnet_emb_batch([texts[i] for i in indices])[:, None])
+    return np.concatenate(vectors).astype(np.float64)
 
 # obtain cosine similarity score between anchor paragraphs and given paragraph
 
 
 def similarity(anchor_paragraphs, paragraph):
-    # convert sequence to id
-    paragraph_emb = mpnet_emb(paragraph)
-    similarity = 0
-    for fragment in anchor_paragraphs:
-        fragment_emb = mpnet_emb(fragment)
-        similarity += np.dot(fragment_emb, paragraph_emb)
-    return similarity / len(anchor_paragraphs)
+    # the anchors and the paragraph are encoded in one batched call
+    embs = paragraph_emb_batch(list(anchor_paragraphs) + [paragraph])
+    return np.dot(embs[:-1], embs[-1]).sum() / len(anchor_paragraphs)
 
 # given a paper, decide anchor paragraph by finding the longest paragraph in the first 1/3 of the paper
 
@@ -80,15 +129,29 @@ def get_longest_string_first_half(paper):
 
 def clean_paragraphs(paragraphs, threshold=threshhold_value):
     cleaned_paragraphs = []
+    if not paragraphs:
+        return cleaned_paragraphs
     anchor_paragraph = get_longest_string_first_half(paragraphs)
-    anchor_paragraphs = [anchor_paragraph]
+    # every paragraph is encoded once, the anchor is one of them unless the first 1/3 is empty
+    texts = list(paragraphs)
+    first_half = paragraphs[:len(paragraphs) // 3]
+    anchor_ids = [first_half.index(anchor_paragraph) if anchor_paragraph in first_half else len(texts)]
+    if anchor_ids[0] == len(texts):
+        texts.append(anchor_paragraph)
+    embs = paragraph_emb_batch(texts)
+    # similarity of every paragraph to the anchors is one matrix product,
+    # recomputed only when the anchors change
+    scores = None
     for idx, paragraph in enumerate(paragraphs):
-        score = similarity(anchor_paragraphs, paragraph)
+        if scores is None:
+            scores = (embs[:len(paragraphs)] @ embs[anchor_ids].T).sum(axis=1) / len(anchor_ids)
+        score = scores[idx]
         if score > threshold:
             cleaned_paragraphs.append(paragraph)
-            if len(anchor_paragraphs) == 5:
-                del anchor_paragraphs[0]
-                anchor_paragraphs.append(paragraph)
+            if len(anchor_ids) == 5:
+                del anchor_ids[0]
+                anchor_ids.append(idx)
+                scores = None
     return cleaned_paragraphs
 
 # concatenate incomplete paragraphs across two pages
@@ -121,4 +184,4 @@ def concat_paragraphs(paragraphs):
 
 
 if __name__ == "__main__":
-    print("Using device:", device)
+    print("Using device:", registry.torch_device())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cosine drift of the int8 CPU encoders against fp32.
+
+The noise filter (pdf2text.config.cleanQuantize) and TopicSegmentor(quantize=True) can run their
+encoders with dynamic int8 linear layers. check() encodes a reference set with both versions of each
+encoder and reports how far the int8 embeddings drift from the fp32 ones:
+
+    python -m ReactionMiner.quantization [results/paper.json ...]
+
+uses the paragraphs of the given parsed papers as reference set, or a built-in one if none is given.
+"""
+
+import json
+import sys
+
+import numpy as np
+
+from . import registry
+
+REFERENCE_TEXTS = [
+    "To a solution of benzaldehyde (1.06 g, 10 mmol) in dry THF (20 mL) was added phenylmagnesium bromide "
+    "(1.0 M in THF, 12 mL) dropwise at 0 °C under argon.",
+    "The reaction mixture was stirred at room temperature for 12 h, quenched with saturated aqueous NH4Cl "
+    "and extracted with ethyl acetate (3 × 20 mL).",
+    "The combined organic layers were dried over anhydrous Na2SO4, filtered and concentrated under reduced pressure.",
+    "The crude product was purified by flash column chromatography on silica gel (hexane/EtOAc 10:1) "
+    "to afford the alcohol as a colorless oil (1.62 g, 88% yield).",
+    "Pd(PPh3)4 (5 mol %) and K2CO3 (2.0 equiv) were added, and the suspension was heated to reflux overnight.",
+    "1H NMR (400 MHz, CDCl3) δ 7.38–7.25 (m, 10H), 5.84 (s, 1H), 2.21 (br s, 1H).",
+    "The enzyme was expressed in E. coli BL21(DE3), and the cells were lysed by sonication and centrifuged.",
+    "Catalytic asymmetric hydrogenation remains one of the most efficient routes to chiral amines.",
+    "Herein we report a copper-catalyzed cross-coupling of aryl halides with amides under mild conditions.",
+    "We thank the National Science Foundation for financial support of this work.",
+    "Received: March 2, 2021; Published: May 14, 2021",
+    "Figure 3. X-ray crystal structure of compound 5b with thermal ellipsoids drawn at 50% probability.",
+]
+
+
+def cosine_drift(reference, quantized):
+    """
+    Returns summary statistics of 1 - cos(reference[i], quantized[i]) over the rows of two embedding matrices.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    quantized = np.asarray(quantized, dtype=np.float64)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(quantized, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine = (reference * quantized).sum(axis=1) / norms
+    drift = 1 - np.nan_to_num(cosine)
+    return {
+        "texts": len(drift),
+        "mean": float(drift.mean()),
+        "p95": float(np.percentile(drift, 95)),
+        "max": float(drift.max()),
+    }
+
+
+def mpnet_drift(texts):
+    """
+    Cosine drift of the int8 noise filter encoder (pdf2text.postprocess) against fp32.
+    """
+    from .pdf2text.postprocess import mpnet_emb_batch
+    return cosine_drift(mpnet_emb_batch(texts, quantize=False), mpnet_emb_batch(texts, quantize=True))
+
+
+def specter_drift(texts):
+    """
+    Cosine drift of the int8 TopicSegmentor encoder (allenai-specter) against fp32.
+    """
+    reference = registry.sentence_transformer('allenai-specter', device='cpu').encode(texts)
+    quantized = registry.sentence_transformer('allenai-specter', quantize=True).encode(texts)
+    return cosine_drift(reference, quantized)
+
+
+def check(texts=REFERENCE_TEXTS):
+    """
+    Returns the cosine drift of both int8 encoders against fp32 on texts, see cosine_drift().
+    """
+    texts = [text for text in texts if text.strip()]
+    return {"mpnet": mpnet_drift(texts), "specter": specter_drift(texts)}
+
+
+def main(paths):
+    texts = REFERENCE_TEXTS
+    if paths:
+        texts = []
+        for path in paths:
+            with open(path) as fin:
+                texts += json.load(fin)["contents"]
+    for encoder, drift in check(texts).items():
+        print(f"{encoder}: mean drift {drift['mean']:.2e}, p95 {drift['p95']:.2e}, max {drift['max']:.2e} "
+              f"over {drift['texts']} texts")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
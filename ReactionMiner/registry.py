@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared registry of models and heavy libraries.
+
+Nothing is imported or loaded when the package is imported: each model is loaded on first use,
+once per process, and then shared by every stage that asks for it.
+"""
+
+import threading
+
+_objects = {}
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def get(key, loader):
+    """
+    Returns the object registered under key, calling loader() to create it on first use.
+
+    Concurrent first calls for the same key load it only once.
+    """
+    try:
+        return _objects[key]
+    except KeyError:
+        pass
+    with _registry_lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _objects:
+            _objects[key] = loader()
+        return _objects[key]
+
+
+def clear(key=None):
+    """
+    Drops the object registered under key, or every object if key is None, so it can be garbage collected.
+    """
+    with _registry_lock:
+        if key is None:
+            _objects.clear()
+        else:
+            _objects.pop(key, None)
+
+
+def torch_device():
+    """
+    Returns the torch device the pipeline runs its encoders on: CUDA if available, CPU otherwise.
+    """
+    def load():
+        import torch
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return get("torch_device", load)
+
+
+def transformer(model_name, quantize=False, **model_kwargs):
+    """
+    Returns the (tokenizer, model) pair of a Hugging Face model, with the model on torch_device().
+
+    With quantize=True the model runs on CPU with dynamic int8 linear layers, see quantize_dynamic().
+    """
+    def load():
+        from transformers import AutoModel, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name, **model_kwargs)
+        model = quantize_dynamic(model) if quantize else model.to(torch_device())
+        return tokenizer, model
+    return get(("transformer", model_name, quantize, tuple(sorted(model_kwargs.items()))), load)
+
+
+def sentence_transformer(model_name, device=None, quantize=False):
+    """
+    Returns a SentenceTransformer model.
+
+    With quantize=True the model runs on CPU with dynamic int8 linear layers, see quantize_dynamic().
+    """
+    def load():
+        from sentence_transformers import SentenceTransformer
+        if quantize:
+            return quantize_dynamic(SentenceTransformer(model_name, device="cpu"))
+        return SentenceTransformer(model_name, device=device)
+    return get(("sentence_transformer", model_name, device, quantize), load)
+
+
+def embedding_pool(model_name, workers, threads=None, quantize=False):
+    """
+    Returns a pool of CPU worker processes encoding with a SentenceTransformer model, see ReactionMiner.embedding_pool.
+    """
+    def load():
+        from .embedding_pool import EmbeddingPool
+        return EmbeddingPool(model_name, workers, threads=threads, quantize=quantize)
+    return get(("embedding_pool", model_name, workers, threads, quantize), load)
+
+
+def quantize_dynamic(model):
+    """
+    Returns a CPU copy of model with its linear layers quantized to int8 (weights ahead of time,
+    activations on the fly), and pins the CPU threads with set_cpu_threads() unless that was done already.
+    """
+    import torch
+    if "cpu_threads" not in _objects:
+        set_cpu_threads()
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def set_cpu_threads(num_threads=None):
+    """
+    Sets the torch intra-op thread pool to num_threads (default: every core of the machine) with a single
+    inter-op thread, the setting int8 encoders run fastest with on a dedicated CPU node.
+    """
+    import os
+    import torch
+    if not num_threads:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before torch runs any parallel work
+        pass
+    _objects["cpu_threads"] = num_threads
+    return num_threads
+
+
+def shared_encoder(model_name, quantize=False):
+    """
+    Returns the SentenceEncoder of model_name shared by the noise filter and TopicSegmentor, see ReactionMiner.encoder.
+    """
+    def load():
+        from .encoder import SentenceEncoder
+        return SentenceEncoder(model_name, quantize=quantize)
+    return get(("shared_encoder", model_name, quantize), load)
+
+
+def paragraph_cache(path):
+    """
+    Returns the ParagraphCache stored in the directory path, see ReactionMiner.paragraph_cache.
+    """
+    import os
+
+    def load():
+        from .paragraph_cache import ParagraphCache
+        return ParagraphCache(path)
+    return get(("paragraph_cache", os.path.abspath(path)), load)
+
+
+def spacy_nlp(model_name="en_core_web_sm"):
+    """
+    Returns a spaCy pipeline, downloading the model first if it is not installed.
+    """
+    return get(("spacy", model_name), lambda: _spacy_load(model_name))
+
+
+def spacy_sentencizer(model_name="en_core_web_sm"):
+    """
+    Returns a spaCy pipeline that only splits sentences: the tagger, parser, NER and lemmatizer are excluded,
+    and the sentence recognizer of the model is enabled, or the rule-based sentencizer if it has none.
+    """
+    def load():
+        nlp = _spacy_load(model_name, exclude=["tagger", "parser", "attribute_ruler", "lemmatizer", "ner"])
+        if "senter" in nlp.disabled:
+            nlp.enable_pipe("senter")
+        elif "senter" not in nlp.pipe_names:
+            nlp.add_pipe("sentencizer")
+        # the shared token vectors are only needed if the sentence recognizer listens to them
+        if "tok2vec" in nlp.pipe_names and not nlp.get_pipe("tok2vec").listening_components:
+            nlp.disable_pipe("tok2vec")
+        return nlp
+    return get(("spacy_sentencizer", model_name), load)
+
+
+def _spacy_load(model_name, **kwargs):
+    import spacy
+    if not spacy.util.is_package(model_name):
+        spacy.cli.download(model_name)
+    return spacy.load(model_name, **kwargs)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Quality and speed of the lexical (TF-IDF) segmentation mode against the embedding (SPECTER) mode.
+
+    python -m ReactionMiner.segmentation.compare results/paper.json [...]
+
+segments the paragraphs ('contents') of each parsed paper with both modes and reports the time each
+one takes to vectorize and segment the sentences, and how far the lexical segmentation is from the
+embedding one taken as reference: Pk and WindowDiff over the C99 boundaries of the paragraphs with a
+keyword hit (lower is better), and the share of the sentences extracted by either mode that both extract.
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+from .segmentor import TopicSegmentor
+
+
+def labels(boundary):
+    # the topic label of each item of a C99 boundary list
+    return np.cumsum(boundary)
+
+
+def pk(reference, hypothesis, k=None):
+    """
+    Returns the Pk error of the boundary list hypothesis against reference: the probability that two
+    items k apart are wrongly said to be in the same topic or in different ones.
+    """
+    reference, hypothesis = labels(reference), labels(hypothesis)
+    n = len(reference)
+    k = k or max(1, int(round(n / (2.0 * max(1, reference[-1] if n else 1)))))
+    if n <= k:
+        return 0.0
+    same_reference = reference[k:] == reference[:-k]
+    same_hypothesis = hypothesis[k:] == hypothesis[:-k]
+    return float(np.mean(same_reference != same_hypothesis))
+
+
+def window_diff(reference, hypothesis, k=None):
+    """
+    Returns the WindowDiff error of the boundary list hypothesis against reference: the share of
+    windows of k items in which they count a different number of boundaries.
+    """
+    reference, hypothesis = labels(reference), labels(hypothesis)
+    n = len(reference)
+    k = k or max(1, int(round(n / (2.0 * max(1, reference[-1] if n else 1)))))
+    if n <= k:
+        return 0.0
+    return float(np.mean((reference[k:] - reference[:-k]) != (hypothesis[k:] - hypothesis[:-k])))
+
+
+def boundaries(segmentor, paragraphs):
+    """
+    Returns the time segmentor takes to vectorize and segment the sentences of paragraphs, and the C99
+    boundaries of each paragraph with a keyword hit, by paragraph id.
+    """
+    # sentence splitting and keyword tagging are the same in both modes, they are kept out of the timings
+    sentences = segmentor.split(paragraphs)
+    hits = segmentor.keyword_hits(paragraphs, sentences)
+    hit_ids = [i for i in range(len(paragraphs)) if hits[i]]
+    start = time.perf_counter()
+    embeddings = dict(zip(hit_ids, segmentor.embed([paragraphs[i] for i in hit_ids], [sentences[i] for i in hit_ids])))
+    result = {}
+    for i in range(len(paragraphs)):
+        if i not in embeddings:
+            segmentor.model.skip(len(sentences[i]))
+            continue
+        result[i] = segmentor.model.segment(embeddings[i])
+    return time.perf_counter() - start, result
+
+
+def compare(documents, **kwargs):
+    """
+    Returns the speed and quality report of the lexical mode against the embedding mode on documents, lists of
+    paragraphs; keyword arguments are passed to both TopicSegmentors.
+    """
+    report = {}
+    segments = {}
+    splits = {}
+    for mode, lexical in (("embedding", False), ("lexical", True)):
+        start = time.perf_counter()
+        segmentor = TopicSegmentor(lexical=lexical, **kwargs)
+        load = time.perf_counter() - start
+        elapsed = 0.0
+        splits[mode] = {}
+        for d_id, document in enumerate(documents):
+            segmentor.model.window = 4
+            seconds, result = boundaries(segmentor, document)
+            elapsed += seconds
+            splits[mode].update({(d_id, i): boundary for i, boundary in result.items()})
+        segments[mode] = set()
+        for document in documents:
+            segmentor.model.window = 4
+            segments[mode].update(segmentor.segment(document))
+        sentences = sum(len(boundary) for boundary in splits[mode].values())
+        report[mode] = {"load_seconds": load, "segment_seconds": elapsed,
+                        "sentences_per_second": sentences / elapsed if elapsed else float("inf")}
+    pairs = [(splits["embedding"][key], splits["lexical"][key]) for key in splits["embedding"]]
+    union = segments["embedding"] | segments["lexical"]
+    report["agreement"] = {
+        "paragraphs": len(pairs),
+        "pk": float(np.mean([pk(*pair) for pair in pairs])) if pairs else 0.0,
+        "window_diff": float(np.mean([window_diff(*pair) for pair in pairs])) if pairs else 0.0,
+        "sentence_overlap": len(segments["embedding"] & segments["lexical"]) / len(union) if union else 1.0,
+    }
+    return report
+
+
+def main(paths):
+    documents = []
+    for path in paths:
+        with open(path) as fin:
+            documents.append(json.load(fin)["contents"])
+    report = compare(documents)
+    for mode in ("embedding", "lexical"):
+        print(f"{mode}: model load {report[mode]['load_seconds']:.2f} s, segmentation {report[mode]['segment_seconds']:.3f} s "
+              f"({report[mode]['sentences_per_second']:.0f} sentences/s)")
+    agreement = report["agreement"]
+    print(f"lexical vs embedding over {agreement['paragraphs']} paragraphs: Pk {agreement['pk']:.3f}, "
+          f"WindowDiff {agreement['window_diff']:.3f}, sentence overlap {agreement['sentence_overlap']:.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m ReactionMiner.segmentation.compare results/paper.json [...]")
+        sys.exit(2)
+    main(sys.argv[1:])
@@ -1,16 +1,46 @@
-from sentence_transformers import SentenceTransformer
-import torch
-from tqdm import tqdm
-import spacy
+import re
+from itertools import islice
 from collections import Counter
 import numpy as np
 
+from .. import registry
+from ..paragraph_cache import digest, namespace
 
-# Download the en_core_web_sm model if not already installed
-if not spacy.util.is_package("en_core_web_sm"):
-    spacy.cli.download("en_core_web_sm")
-# load core english library
-nlp = spacy.load("en_core_web_sm")
+
+# core english library, downloaded and loaded on first use
+def __getattr__(name):
+    if name == "nlp":
+        return registry.spacy_nlp("en_core_web_sm")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# sentence splitting pipeline, part of the namespace of everything cached per sentence
+SENTENCE_SPLITTER = namespace('senter', 'en_core_web_sm')
+
+
+def split_sentences(paragraphs, batch_size=64, n_process=1, cache=None):
+    """
+    Returns the sentences of each paragraph, split in batches of batch_size paragraphs
+    by n_process processes with the sentence-only pipeline of registry.spacy_sentencizer.
+    The sentence spans are read from and written to cache, a ParagraphCache, if given.
+    """
+    def compute(indices):
+        nlp = registry.spacy_sentencizer("en_core_web_sm")
+        docs = nlp.pipe([paragraphs[i] for i in indices], batch_size=batch_size, n_process=n_process)
+        return [[[s.start_char, s.end_char] for s in doc.sents] for doc in docs]
+    if cache is None:
+        spans = compute(range(len(paragraphs)))
+    else:
+        spans = cache.records(namespace('sentence_spans', SENTENCE_SPLITTER), paragraphs, compute)
+    return [[paragraph[start:end] for start, end in paragraph_spans]
+            for paragraph, paragraph_spans in zip(paragraphs, spans)]
+
+
+def sentence_vectors_namespace(model_name, quantize=False):
+    """
+    Returns the ParagraphCache namespace of the sentence vectors of a paragraph embedded by model_name.
+    """
+    return namespace('sentence_vectors', model_name, 'int8' if quantize else 'fp32', SENTENCE_SPLITTER)
 
 
 def cosine_sim(c1, c2):
@@ -32,6 +62,109 @@ def cosine_sim(c1, c2):
     except:
         return 0
 
+def similarity_matrix(cnts):
+    """
+    Returns the matrix of cosine_sim between every pair of items of cnts.
+
+    A 2-D float matrix of embeddings is computed with array operations that round exactly like
+    cosine_sim does: the dot products are accumulated sequentially in the input dtype, one
+    dimension at a time, as Python's sum() does over the items of a row.
+    """
+    if hasattr(cnts, 'tocsr'):
+        return sparse_similarity_matrix(cnts)
+    n = len(cnts)
+    emb = np.asarray(cnts) if n else None
+    if emb is None or emb.ndim != 2 or emb.dtype.kind != 'f':
+        # Counter and other inputs
+        sim = np.zeros((n, n))
+        for i in range(n):
+            for j in range(i, n):
+                sim[i][j] = cosine_sim(cnts[i], cnts[j])
+                sim[j][i] = sim[i][j]
+        return sim
+    num = np.zeros((n, n), dtype=emb.dtype)
+    for column in emb.T:
+        num += np.multiply.outer(column, column)
+    norm = np.sqrt(np.diagonal(num))
+    den = np.multiply.outer(norm, norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sim = np.where(den < 1e-9, 0, num / den).astype(np.float64)
+    # mirror the upper triangle, as the pairwise loop does
+    return np.where(np.triu(np.ones((n, n), dtype=bool)), sim, sim.T)
+
+
+def sparse_similarity_matrix(vectors):
+    """
+    Returns the cosine similarity matrix of the rows of a scipy sparse matrix, with one sparse
+    product of the normalized rows; the similarity of an all-zero row is 0.
+    """
+    vectors = vectors.tocsr().astype(np.float64)
+    norm = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    scale = np.divide(1.0, norm, out=np.zeros_like(norm), where=norm > 0)
+    vectors = vectors.multiply(scale[:, None]).tocsr()
+    sim = (vectors @ vectors.T).toarray()
+    n = len(sim)
+    return np.where(np.triu(np.ones((n, n), dtype=bool)), sim, sim.T)
+
+
+def tfidf_vectors(sentences, tokenizer=None):
+    """
+    Returns the TF-IDF term vectors of sentences, as a scipy sparse matrix with one row per sentence.
+
+    Term frequencies are weighted by the smoothed inverse frequency of each term among the
+    sentences, idf = ln((1 + n) / (1 + df)) + 1, so the vectors of a paragraph only depend on it.
+    """
+    from scipy import sparse
+    tokenizer = tokenizer or WordTokenizer()
+    vocabulary = {}
+    rows, columns = [], []
+    for row, sentence in enumerate(sentences):
+        for token in tokenizer.tokenize(sentence):
+            rows.append(row)
+            columns.append(vocabulary.setdefault(token, len(vocabulary)))
+    tf = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(sentences), len(vocabulary)))
+    tf.sum_duplicates()
+    df = np.bincount(tf.indices, minlength=len(vocabulary))
+    idf = np.log((1 + len(sentences)) / (1 + df)) + 1
+    return tf.multiply(idf[None, :]).tocsr()
+
+
+def rank_matrix(sim, window):
+    """
+    Returns the local rank matrix of C99: the share of the similarities in the (2 * window - 1)^2
+    neighbourhood of each cell, clipped to the matrix, that are lower than the cell.
+    """
+    n = len(sim)
+    pad = window - 1
+    # padding with inf keeps the cells outside of the matrix out of the count
+    padded = np.pad(sim, pad, constant_values=np.inf)
+    neighbours = np.lib.stride_tricks.sliding_window_view(padded, (2 * window - 1, 2 * window - 1))
+    lower = (neighbours < sim[:, :, None, None]).sum(axis=(2, 3))
+    index = np.arange(n)
+    size = np.minimum(n - 1, index + window - 1) - np.maximum(0, index - window + 1) + 1
+    rank = 1.0 * lower / np.multiply.outer(size, size)
+    return np.where(np.triu(np.ones((n, n), dtype=bool)), rank, rank.T)
+
+
+def sum_matrix(rank):
+    """
+    Returns the matrix of sums of rank over every square block [i, j] x [i, j].
+
+    The 2-D prefix sums follow the recurrence of the original loops, term for term, one
+    anti-diagonal at a time, so the sums are rounded exactly as they were.
+    """
+    n = len(rank)
+    # prefix[i + 1][j + 1] is the sum of rank[:i + 1, :j + 1], the zero border stands for the missing terms
+    prefix = np.zeros((n + 1, n + 1))
+    for k in range(2 * n - 1):
+        i = np.arange(max(0, k - n + 1), min(k, n - 1) + 1)
+        j = k - i
+        prefix[i + 1, j + 1] = ((rank[i, j] + prefix[i, j + 1]) + prefix[i + 1, j]) - prefix[i, j]
+    corner = np.diagonal(prefix)
+    sm = ((corner[None, 1:] - prefix[:n, 1:]) - prefix[1:, :n].T) + corner[:n, None]
+    return np.where(np.triu(np.ones((n, n), dtype=bool)), sm, sm.T)
+
+
 class EnglishTokenizer:
     """
     A tokenizer is a class with tokenize(text) method
@@ -42,6 +175,15 @@ class EnglishTokenizer:
     def tokenize(self, text):
         return text.lower().split()
 
+class WordTokenizer:
+    """
+    Tokenizer splitting lowercased text into words, punctuation left out
+    """
+    pattern = re.compile(r'\w+')
+
+    def tokenize(self, text):
+        return self.pattern.findall(text.lower())
+
 class C99:
     """
     Reference:
@@ -68,11 +210,12 @@ class C99:
             i-th element denotes whether exists a boundary right before paragraph i(0 indexed)
         """
         #assert(len(document) > 0 and len([d for d in document if not isinstance(d, str)]) == 0)
-        if len(document) < 3:
-            return [1] + [0 for _ in range(len(document) - 1)]
+        # a scipy sparse matrix of term vectors has no len()
+        n = document.shape[0] if hasattr(document, 'tocsr') else len(document)
+        if n < 3:
+            return [1] + [0 for _ in range(n - 1)]
         # step 1, preprocessing
-        n = len(document)
-        self.window = min(self.window, n)
+        self.skip(n)
         
         
         #cnts = [Counter(self.tokenizer.tokenize(document[i])) for i in range(n)]
@@ -81,66 +224,49 @@ class C99:
         
 
         # step 2, compute similarity matrix
-        self.sim = np.zeros((n, n))
-        for i in range(n):
-            for j in range(i, n):
-                self.sim[i][j] = cosine_sim(cnts[i], cnts[j])
-                self.sim[j][i] = self.sim[i][j]
+        self.sim = similarity_matrix(cnts)
 
         # step 3, compute rank matrix & sum matrix
-        self.rank = np.zeros((n, n))
-        for i in range(n):
-            for j in range(i, n):
-                r1 = max(0, i - self.window + 1)
-                r2 = min(n - 1, i + self.window - 1)
-                c1 = max(0, j - self.window + 1)
-                c2 = min(n - 1, j + self.window - 1)
-                sublist = self.sim[r1:(r2 + 1), c1:(c2+1)].flatten()
-                lowlist = [x for x in sublist if x < self.sim[i][j]]
-                self.rank[i][j] = 1.0 * len(lowlist) / ((r2 - r1 + 1) * (c2 - c1 + 1))
-                self.rank[j][i] = self.rank[i][j]
-
-        self.sm = np.zeros((n, n))
+        self.rank = rank_matrix(self.sim, self.window)
+
         # O(n^4) solution
         # for i in xrange(n):
         #     for j in xrange(i, n):
         #         self.sm[i][j] = sum(self.rank[i:(j + 1), i:(j + 1)].flatten())
         #         self.sm[j][i] = self.sm[i][j]
         # O(n^2) solution
-        prefix_sm = np.zeros((n, n))
-        for i in range(n):
-            for j in range(n):
-                prefix_sm[i][j] = self.rank[i][j]
-                if i - 1 >= 0: prefix_sm[i][j] += prefix_sm[i - 1][j]
-                if j - 1 >= 0: prefix_sm[i][j] += prefix_sm[i][j - 1]
-                if i - 1 >= 0 and j - 1 >= 0: prefix_sm[i][j] -= prefix_sm[i - 1][j - 1]
-        for i in range(n):
-            for j in range(i, n):
-                if i == 0:
-                    self.sm[i][j] = prefix_sm[j][j]
-                else:
-                    self.sm[i][j] = prefix_sm[j][j] - prefix_sm[i - 1][j] \
-                                    - prefix_sm[j][i - 1] + prefix_sm[i - 1][i - 1]
-                self.sm[j][i] = self.sm[i][j]
+        self.sm = sum_matrix(self.rank)
 
         # step 4, determine boundaries
         D = 1.0 * self.sm[0][n - 1] / (n * n)
-        darr, region_arr, idx = [D], [Region(0, n - 1, self.sm)], []
+        darr, idx = [D], []
         sum_region, sum_area = float(self.sm[0][n - 1]), float(n * n)
-        for i in range(n - 1):
-            mx, pos = -1e9, -1
-            for j, region in enumerate(region_arr):
-                if region.l == region.r:
-                    continue
+        # the regions partition [0, n), each one is kept at the index of its first item, with the sums
+        # and areas of its best split, so the density of every possible next split is one array expression
+        regions = [None] * n
+        tot, ltot, rtot = np.zeros(n), np.zeros(n), np.zeros(n)
+        area, larea, rarea = np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+        splittable = np.zeros(n, dtype=bool)
+
+        def add(region):
+            regions[region.l] = region
+            splittable[region.l] = region.l != region.r
+            if region.l != region.r:
                 region.split(self.sm)
-                den = sum_area - region.area + region.lch.area + region.rch.area
-                cur = (sum_region - region.tot + region.lch.tot + region.rch.tot) / den
-                if cur > mx:
-                    mx, pos = cur, j
-            assert(pos >= 0)
-            tmp = region_arr[pos]
-            region_arr[pos] = tmp.rch
-            region_arr.insert(pos, tmp.lch)
+                tot[region.l], ltot[region.l], rtot[region.l] = region.tot, region.lch.tot, region.rch.tot
+                area[region.l], larea[region.l], rarea[region.l] = region.area, region.lch.area, region.rch.area
+
+        add(Region(0, n - 1, self.sm))
+        for i in range(n - 1):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cur = (((sum_region - tot) + ltot) + rtot) / (((sum_area - area) + larea) + rarea)
+            # the first region with the highest density wins, as in a scan with a strict comparison
+            cur[~(splittable & (cur > -1e9))] = -np.inf
+            pos = int(np.argmax(cur))
+            assert(cur[pos] > -1e9)
+            tmp = regions[pos]
+            add(tmp.lch)
+            add(tmp.rch)
             sum_region += tmp.lch.tot + tmp.rch.tot - tmp.tot
             sum_area += tmp.lch.area + tmp.rch.area - tmp.area
             darr.append(sum_region / sum_area)
@@ -173,11 +299,21 @@ class C99:
                     break
         return [1] + ret[:-1]
 
+    def skip(self, n):
+        """
+        Applies the change segment() makes to the model on a document of n items, without segmenting it:
+        the window is clamped to the longest document, once it has at least 3 items.
+        """
+        if n >= 3:
+            self.window = min(self.window, n)
+
 class Region:
     """
     Used to denote a rectangular region of similarity matrix,
     never instantiate this class outside the package.
     """
+    __slots__ = ('tot', 'l', 'r', 'area', 'lch', 'rch', 'best_pos')
+
     def __init__(self, l, r, sm_matrix):
         assert(r >= l)
         self.tot = sm_matrix[l][r]
@@ -193,23 +329,106 @@ class Region:
             self.best_pos = self.l
             return
         assert(self.r > self.l)
-        mx, pos = -1e9, -1
-        for i in range(self.l, self.r):
-            carea = (i - self.l + 1)**2 + (self.r - i)**2
-            cur = (sm_matrix[self.l][i] + sm_matrix[i + 1][self.r]) / carea
-            if cur > mx:
-                mx, pos = cur, i
-        assert(pos >= self.l and pos < self.r)
+        i = np.arange(self.l, self.r)
+        carea = (i - self.l + 1)**2 + (self.r - i)**2
+        cur = (sm_matrix[self.l, self.l:self.r] + sm_matrix[self.l + 1:self.r + 1, self.r]) / carea
+        # the first best position wins, as in a scan with a strict comparison
+        cur[~(cur > -1e9)] = -np.inf
+        pos = self.l + int(np.argmax(cur))
+        assert(cur[pos - self.l] > -1e9)
         self.lch = Region(self.l, pos, sm_matrix)
         self.rch = Region(pos + 1, self.r, sm_matrix)
         self.best_pos = pos
 
 
+class KeywordMatcher:
+    """
+    Finds keywords in a text with a regular expression compiled once, shaped like a trie of the
+    keywords so each position of the text is tried against shared prefixes in a single pass,
+    matching like the substring test `keyword in text`.
+    """
+    def __init__(self, keywords):
+        # duplicates removed, first occurrence kept
+        self.keywords = list(dict.fromkeys(keywords))
+        if self.keywords:
+            trie = {}
+            for keyword in self.keywords:
+                node = trie
+                for char in keyword:
+                    node = node.setdefault(char, {})
+                node[''] = {}
+            pattern = _trie_pattern(trie)
+            self.pattern = re.compile(pattern)
+            # the lookahead reports keywords that overlap
+            self.overlapping = re.compile('(?=(' + pattern + '))')
+        else:
+            # an empty keyword list never matches
+            self.pattern = self.overlapping = None
+
+    def search(self, text):
+        """
+        Returns whether any keyword occurs in text.
+        """
+        return self.pattern is not None and self.pattern.search(text) is not None
+
+    def findall(self, text, positions=False):
+        """
+        Returns the keywords found in text in order of position, the longest one for each position where
+        keywords start, as (keyword, start, end) tuples if positions is True.
+        """
+        if self.overlapping is None:
+            return []
+        if positions:
+            return [(m.group(1), m.start(), m.start() + len(m.group(1))) for m in self.overlapping.finditer(text)]
+        return [m.group(1) for m in self.overlapping.finditer(text)]
+
+
+def _trie_pattern(node):
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in node.items() if char]
+    if not branches:
+        return ''
+    pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # a keyword ends here, the greedy optional prefers the longer keywords going on
+        return '(?:' + pattern + ')?'
+    return pattern
+
+
+def shared_encoder_name(quantize):
+    """
+    Returns the model of the encoder TopicSegmentor(shared_encoder=True) shares with the noise filter,
+    raising a ValueError if the noise filter is not configured to run the same model the same way.
+    """
+    from ..pdf2text import config
+    if not config.sharedEncoder:
+        raise ValueError("shared_encoder=True needs pdf2text.config.sharedEncoder, the encoder the noise filter shares")
+    if bool(quantize) != bool(config.cleanQuantize):
+        raise ValueError(f"shared_encoder=True with quantize={quantize}, but pdf2text.config.cleanQuantize is "
+                         f"{config.cleanQuantize}: the noise filter and segmentation would load two encoders")
+    return config.sharedEncoder
+
+
 class TopicSegmentor:
-    def __init__(self, device='cuda:0', keywords=None):
-        self.device = torch.device(device)
-        # self.embedder = SentenceTransformer('bert-base-nli-stsb-mean-tokens')
-        self.embedder = SentenceTransformer('allenai-specter')
+    def __init__(self, device=None, keywords=None, quantize=False, shared_encoder=False,
+                 spacy_batch_size=64, spacy_processes=1, encode_batch_size=32, paragraph_cache=None,
+                 embedding_workers=0, worker_threads=None, lexical=False):
+        # lexical segments with TF-IDF term vectors of the sentences instead of SPECTER embeddings,
+        # no encoder is loaded and the embedding options are ignored
+        self.lexical = lexical
+        self.tokenizer = WordTokenizer()
+        # sentence spans, keyword hits and embeddings of each paragraph are kept in the
+        # ParagraphCache stored in the directory paragraph_cache, see ReactionMiner/paragraph_cache.py
+        self.cache = registry.paragraph_cache(paragraph_cache) if paragraph_cache else None
+        self.vectors_namespace = sentence_vectors_namespace('allenai-specter', quantize)
+        # sentences of a document are encoded encode_batch_size at a time
+        self.encode_batch_size = encode_batch_size
+        # sentence splitting runs spacy_batch_size paragraphs at a time in spacy_processes processes
+        self.spacy_batch_size = spacy_batch_size
+        self.spacy_processes = spacy_processes
+        self.device = None
+        self.encoder, self.pool, self.embedder = None, None, None
+        if not lexical:
+            self.init_embedder(device, quantize, shared_encoder, embedding_workers, worker_threads)
         if keywords == None:
             self.keywords = ['amplified',
                                         'cloning',
@@ -375,65 +594,192 @@ class TopicSegmentor:
             self.keywords = keywords
         self.model = C99(window = 4, std_coeff = 1)
 
+    def init_embedder(self, device, quantize, shared_encoder, embedding_workers, worker_threads):
+        import torch
+        # device defaults to registry.torch_device(),
+        # quantize runs the embedder on CPU with int8 linear layers, see ReactionMiner/quantization.py
+        self.device = torch.device('cpu' if quantize else device or registry.torch_device())
+        # self.embedder = SentenceTransformer('bert-base-nli-stsb-mean-tokens')
+        if shared_encoder:
+            # embed sentences with the encoder of the noise filter, pdf2text.config.sharedEncoder, reusing the
+            # vectors it cached (on registry.torch_device()), see ReactionMiner/encoder.py
+            self.encoder = registry.shared_encoder(shared_encoder_name(quantize), quantize=quantize)
+            self.embedder = self.encoder.model
+            self.device = self.embedder.device
+            self.vectors_namespace = self.encoder.vectors_namespace
+        elif embedding_workers and self.device.type == 'cpu':
+            # encode in a pool of embedding_workers processes with worker_threads torch threads each
+            # (default: the cores divided among them), kept alive across documents,
+            # see ReactionMiner/embedding_pool.py
+            self.pool = registry.embedding_pool('allenai-specter', embedding_workers, worker_threads, quantize)
+        else:
+            self.embedder = registry.sentence_transformer('allenai-specter', device=str(self.device), quantize=quantize)
+
+    @property
+    def keywords(self):
+        return self._keywords
+
+    @keywords.setter
+    def keywords(self, keywords):
+        # assign a new list to change the keywords, the matcher is compiled here
+        self._keywords = keywords
+        self.matcher = KeywordMatcher(keywords)
+
     def init_keyword(self, sent, keyword_dict):
-        for k in keyword_dict:
-            if k in sent:
-                return True
-        return False
+        if keyword_dict is not self._keywords:
+            return KeywordMatcher(keyword_dict).search(sent)
+        return self.matcher.search(sent)
+
+    def split(self, paragraphs):
+        return split_sentences(paragraphs, self.spacy_batch_size, self.spacy_processes, self.cache)
+
+    def keyword_hits(self, paragraphs, sentences):
+        # the ids of the sentences of each paragraph that contain a keyword
+        def compute(indices):
+            return [[s_id for s_id, s in enumerate(sentences[i]) if self.matcher.search(s)] for i in indices]
+        if self.cache is None:
+            return compute(range(len(paragraphs)))
+        hits_namespace = namespace('keyword_hits', digest(self.matcher.keywords), SENTENCE_SPLITTER)
+        return self.cache.records(hits_namespace, paragraphs, compute)
+
+    def embed(self, paragraphs, sentences):
+        # the embeddings of the sentences of each paragraph, or their TF-IDF term vectors in lexical mode
+        if self.lexical:
+            return [tfidf_vectors(sentences[i], self.tokenizer) for i in range(len(paragraphs))]
+        def compute(indices):
+            import torch
+            # every sentence in one batched encode, then split back by paragraph
+            with torch.no_grad():
+                flat_embeddings = self.encode(flat([sentences[i] for i in indices]))
+            offsets = np.cumsum([0] + [len(sentences[i]) for i in indices])
+            return [flat_embeddings[offsets[k]:offsets[k + 1]] for k in range(len(indices))]
+        if self.cache is None:
+            return compute(range(len(paragraphs)))
+        return self.cache.vectors(self.vectors_namespace, paragraphs, compute)
+
+    def encode(self, sentences):
+        if self.encoder is not None:
+            return self.encoder.encode(sentences, batch_size=self.encode_batch_size)
+        if self.pool is not None:
+            return self.pool.encode(sentences, batch_size=self.encode_batch_size)
+        return self.embedder.encode(sentences, batch_size=self.encode_batch_size, show_progress_bar=True)
 
     def segment(self, context):
-        pos = []
-        sentences = []
-        for c_id, sent in enumerate(context):
-            doc = nlp(sent)
-            sentence = []
-            for s_id, s in enumerate(doc.sents):
-                if self.init_keyword(str(s), self.keywords):
-                    pos.append([c_id, s_id])
-                sentence.append(str(s))
-            sentences.append(sentence)
+        return self.segment_many([context])[0]
+
+    def segment_many(self, documents, chunk_paragraphs=1024):
+        """
+        Segments many documents, each one a list of paragraphs as taken by segment().
+
+        Sentence splitting, keyword tagging and embedding run over the paragraphs of several
+        documents at once, in chunks of at least chunk_paragraphs paragraphs (whole documents).
+
+        Returns:
+            list: The segments of each document, as returned by segment().
+        """
+        results = []
+        chunk = []
+        chunk_size = 0
+        for document in documents:
+            chunk.append(list(document))
+            chunk_size += len(chunk[-1])
+            if chunk_size >= chunk_paragraphs:
+                results += self.segment_chunk(chunk)
+                chunk, chunk_size = [], 0
+        if chunk:
+            results += self.segment_chunk(chunk)
+        return results
+
+    def iter_segment(self, context, chunk_paragraphs=64):
+        """
+        Generator variant of segment(), taking any iterable of paragraphs.
+
+        Paragraphs are split, tagged and embedded chunk_paragraphs at a time, and the segments of each
+        paragraph are yielded as soon as it is segmented, so memory does not grow with the document.
+
+        Yields:
+            tuple: (paragraph id, segment), a segment being the list of sentences of one topic;
+                flat() of the segments is the result of segment().
+        """
+        seen = set()
+        paragraphs = iter(context)
+        start = 0
+        while True:
+            chunk = list(islice(paragraphs, chunk_paragraphs))
+            if not chunk:
+                return
+            sentences, hits, embeddings = self.prepare(chunk)
+            for i in range(len(chunk)):
+                for segment in self.paragraph_segments(sentences[i], hits[i], embeddings[i], seen):
+                    yield start + i, segment
+            start += len(chunk)
+
+    def segment_chunk(self, documents):
+        sentences, hits, embeddings = self.prepare(flat(documents))
+        results = []
+        start = 0
+        for document in documents:
+            seen = set()
+            res = []
+            for i in range(start, start + len(document)):
+                res += self.paragraph_segments(sentences[i], hits[i], embeddings[i], seen)
+            results.append(flat(res))
+            start += len(document)
+        return results
+
+    def prepare(self, context):
+        # the sentences, keyword hits and, for paragraphs with a hit, embeddings of each paragraph
+        sentences = self.split(context)
+        hits = self.keyword_hits(context, sentences)
 
         ### Compute embeddings for topic tagging ###
-        embeddings = []
-        with torch.no_grad():
-            for i in tqdm(range(0, len(sentences))):
-                #tokens_input = tokenize_conv(sent[i]).cuda()
-                embedding = self.embedder.encode(sentences[i])
-                embeddings.append(embedding)
+        # only paragraphs with a keyword hit make it to the result, the others are not embedded
+        hit_ids = [i for i in range(len(context)) if hits[i]]
+        embeddings = [None] * len(context)
+        for i, embedding in zip(hit_ids, self.embed([context[i] for i in hit_ids], [sentences[i] for i in hit_ids])):
+            embeddings[i] = embedding
+        return sentences, hits, embeddings
 
+    def paragraph_segments(self, sentences, hits, embedding, seen):
+        # the segments of a paragraph not in seen, the set of the segments of the document so far
         ### Get the topic taggings ###
-        sent_label = []
-        for i in range(0, len(embeddings)):
-            boundary = self.model.segment(embeddings[i])
-            temp_labels = []
-            l = 0
-            for j in range(0, len(boundary)):
-                if boundary[j] == 1:
-                    l += 1
-                temp_labels.append(l)
-            sent_label.append(temp_labels)
+        if embedding is None:
+            # no keyword hit, C99 is skipped but its model changes as if it was not
+            self.model.skip(len(sentences))
+            return []
+        boundary = self.model.segment(embedding)
+        topic = []
+        l = 0
+        for j in range(0, len(boundary)):
+            if boundary[j] == 1:
+                l += 1
+            topic.append(l)
 
         ### Align topic taggins with sentences ###
+        # hits are grouped by topic, each topic segment is built once and
+        # segments with the same sentences are kept once, in order of their first hit
+        assert len(sentences) == len(topic)
+        segments = {}
+        for t_id in range(len(topic)):
+            segments.setdefault(topic[t_id], []).append(sentences[t_id])
         res = []
-        for item in pos:
-            context = sentences[item[0]]
-            topic = sent_label[item[0]]
-            assert len(context) == len(topic)
-            exact_topic = topic[item[1]]
-
-            subres = []
-            for t_id in range(len(topic)):
-                if topic[t_id] == exact_topic:
-                    subres.append(context[t_id])
-            if subres not in res:
+        for s_id in hits:
+            subres = segments.pop(topic[s_id], None)
+            if subres is None:
+                # another hit of this segment came first
+                continue
+            key = tuple(subres)
+            if key not in seen:
+                seen.add(key)
                 res.append(subres)
-
-        return flat(res)
+        return res
     
     def segment_si(self, context):
         res = []
+        seen = set()
         for para in context:
-            if self.init_keyword(para, self.keywords) and (para not in res):
+            if para not in seen and self.matcher.search(para):
+                seen.add(para)
                 res.append(para)
         return res
     